@@ -0,0 +1,269 @@
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+import rail
+
+
+def benchmark_pipe():
+    return lambda: rail.pipe(1, abs, abs, abs)
+
+
+def benchmark_compose(depth):
+    def setup():
+        func = rail.compose(*[abs] * depth)
+        return lambda: func(1)
+    return setup
+
+
+def benchmark_compose_nested(depth):
+    def setup():
+        func = rail.compose()
+        for _ in range(depth):
+            func = rail.compose(func, abs)
+        return lambda: func(1)
+    return setup
+
+
+def benchmark_partial_full():
+    @rail.partial
+    def func(arg1, arg2, arg3):
+        return arg1
+    return lambda: func(1, 2, 3)
+
+
+def benchmark_partial_chained():
+    @rail.partial
+    def func(arg1, arg2, arg3):
+        return arg1
+    return lambda: func(1)(2)(3)
+
+
+def benchmark_partial_bound():
+    @rail.partial
+    def func(arg1, arg2, arg3):
+        return arg1
+    bound_func = func(1, 2)
+    return lambda: bound_func(3)
+
+
+def benchmark_partial_keyword():
+    @rail.partial
+    def func(arg1, arg2, arg3):
+        return arg1
+    bound_func = func(arg2=2)
+    return lambda: bound_func(1, arg3=3)
+
+
+def benchmark_comparison(comparator):
+    def setup():
+        comparison = comparator(5)
+        return lambda: comparison(3)
+    return setup
+
+
+def benchmark_comparison_create():
+    return lambda: rail.eq(5)
+
+
+def benchmark_match(arms, exclusive=False):
+    def setup():
+        func = rail.match(*[
+            (lambda value, index=index: value == index, rail.identity)
+            for index in range(arms)
+        ], exclusive=exclusive)
+        for _ in range(rail.AdaptiveMatch.REORDER_INTERVAL):
+            func(arms - 1)
+        return lambda: func(arms - 1)
+    return setup
+
+
+def benchmark_match_eq(arms):
+    def setup():
+        func = rail.match(*[
+            (rail.eq(index), rail.identity) for index in range(arms)
+        ])
+        return lambda: func(arms - 1)
+    return setup
+
+
+def benchmark_match_range(arms):
+    def setup():
+        func = rail.match(*[
+            (rail.lt(index * 10), rail.identity) for index in range(arms)
+        ])
+        return lambda: func(arms * 10 - 15)
+    return setup
+
+
+def benchmark_match_type(arms):
+    def setup():
+        func = rail.match_type(*[
+            (type('Type{0}'.format(index), (), {}), rail.identity)
+            for index in range(arms - 1)
+        ] + [(int, rail.identity)])
+        return lambda: func(1)
+    return setup
+
+
+def benchmark_match_length(arms):
+    def setup():
+        func = rail.match_length(*[
+            (rail.eq(index), rail.identity) for index in range(arms)
+        ])
+        value = 'x' * (arms - 1)
+        return lambda: func(value)
+    return setup
+
+
+def benchmark_track(is_failure, fail=rail.raise_, compiled=False):
+    def setup():
+        func = rail.Track().compose(
+            lambda value: fail(ValueError(value)) if is_failure else value
+        ).tee(
+            abs
+        ).handle(
+            lambda exception: 0
+        ).fold(
+            abs,
+            lambda exception: 0
+        ).compose(
+            abs
+        )
+        if compiled:
+            func = func.compile()
+        return lambda: func(1)
+    return setup
+
+
+BENCHMARKS = {
+    'pipe': benchmark_pipe,
+    'compose[1]': benchmark_compose(1),
+    'compose[10]': benchmark_compose(10),
+    'compose[100]': benchmark_compose(100),
+    'compose_nested[100]': benchmark_compose_nested(100),
+    'partial_full': benchmark_partial_full,
+    'partial_chained': benchmark_partial_chained,
+    'partial_bound': benchmark_partial_bound,
+    'partial_keyword': benchmark_partial_keyword,
+    'lt': benchmark_comparison(rail.lt),
+    'le': benchmark_comparison(rail.le),
+    'eq': benchmark_comparison(rail.eq),
+    'ne': benchmark_comparison(rail.ne),
+    'gt': benchmark_comparison(rail.gt),
+    'ge': benchmark_comparison(rail.ge),
+    'eq_create': benchmark_comparison_create,
+    'match[20]': benchmark_match(20),
+    'match_exclusive[20]': benchmark_match(20, exclusive=True),
+    'match_eq[20]': benchmark_match_eq(20),
+    'match_range[20]': benchmark_match_range(20),
+    'match_type[20]': benchmark_match_type(20),
+    'match_length[20]': benchmark_match_length(20),
+    'track_success': benchmark_track(is_failure=False),
+    'track_failure': benchmark_track(is_failure=True),
+    'track_failure_value': benchmark_track(
+        is_failure=True, fail=rail.Failure
+    ),
+    'track_compiled_success': benchmark_track(
+        is_failure=False, compiled=True
+    ),
+    'track_compiled_failure': benchmark_track(
+        is_failure=True, compiled=True
+    ),
+}
+
+
+def measure(setup, repeat):
+    timer = timeit.Timer(setup())
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    return {
+        'ns_per_call': best * 1e9,
+        'calls_per_second': 1 / best
+    }
+
+
+def run(names, repeat):
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': {
+            name: measure(BENCHMARKS[name], repeat) for name in names
+        }
+    }
+
+
+def compare(baseline, current):
+    rows = []
+    for name, result in baseline['results'].items():
+        baseline_ns = result['ns_per_call']
+        if name not in current['results']:
+            rows.append((name, baseline_ns, None, None))
+            continue
+        current_ns = current['results'][name]['ns_per_call']
+        rows.append((name, baseline_ns, current_ns, current_ns / baseline_ns))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the rail primitives.'
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--output', help='file to write results to')
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument(
+        'names', nargs='*', help='benchmarks to run, defaults to all'
+    )
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare two sets of results'
+    )
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='allowed slowdown as a fraction of the baseline time'
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        unknown = set(args.names) - set(BENCHMARKS)
+        if unknown:
+            parser.error('unknown benchmarks: {0}'.format(
+                ', '.join(sorted(unknown))
+            ))
+        results = run(args.names or list(BENCHMARKS), args.repeat)
+        for name, result in results['results'].items():
+            print('{0:<24} {1:>12.1f} ns'.format(name, result['ns_per_call']))
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent=2, sort_keys=True)
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    regressions = 0
+    for name, baseline_ns, current_ns, ratio in compare(baseline, current):
+        if current_ns is None:
+            regressions += 1
+            print('{0:<24} {1:>12.1f} ns {2:>15}  MISSING'.format(
+                name, baseline_ns, '-'
+            ))
+            continue
+        is_regression = ratio > 1 + args.threshold
+        regressions += is_regression
+        print('{0:<24} {1:>12.1f} ns {2:>12.1f} ns {3:>7.2f}x{4}'.format(
+            name, baseline_ns, current_ns, ratio,
+            '  REGRESSION' if is_regression else ''
+        ))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
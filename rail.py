@@ -1,5 +1,27 @@
+import asyncio
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import fractions
 import functools
 import inspect
+import itertools
+import json
+import math
+import mmap
+import operator
+import os
+import pickle
+import queue
+import random
+import reprlib
+import sys
+import threading
+import time
+import traceback
+import types
+import weakref
 
 
 def identity(value):
@@ -17,13 +39,24 @@ def raise_(exception=None):
         raise exception
 
 
+class Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+    def __repr__(self):
+        return 'Failure({0!r})'.format(self.exception)
+
+
+class RaisedFailure(Failure):
+    pass
+
+
+def is_failure(value):
+    return value.__class__ is Failure or value.__class__ is RaisedFailure
+
+
 def try_(func, handle):
-    def try_func(arg):
-        try:
-            return func(arg)
-        except Exception as exception:
-            return handle(exception)
-    return try_func
+    return Pipeline.from_funcs(func).handle(handle)
 
 
 class UnmatchedValueError(Exception):
@@ -32,198 +65,820 @@ class UnmatchedValueError(Exception):
         super().__init__(str(value))
 
 
-def match(*args):
-    return lambda value: pipe(
-        next(
-            (map_func for is_match, map_func in args if is_match(value)),
-            lambda _: pipe(value, UnmatchedValueError, raise_)
-        ),
-        call_with(value)
-    )
+class Match:
+    def __init__(self, *args, key=None):
+        self.args = args
+        self.key = key
+        self.steps = compile_arms(args)
 
+    def __call__(self, value):
+        map_func = find_map_func(
+            self.steps,
+            value if self.key is None or not self.steps else self.key(value)
+        )
+        if map_func is None:
+            raise UnmatchedValueError(value)
+        return map_func(value)
+
+
+def find_map_func(steps, subject):
+    for step in steps:
+        map_func = step(subject)
+        if map_func is not None:
+            return map_func
+    return None
+
+
+class Arm:
+    def __init__(self, is_match, map_func):
+        self.is_match = is_match
+        self.map_func = map_func
+
+    def __call__(self, subject):
+        return self.map_func if self.is_match(subject) else None
+
+
+class EqualityTable:
+    KEY_TYPES = frozenset((str, bytes, int, float, bool, type(None)))
+
+    def __init__(self, arms):
+        self.arms = tuple(Arm(*arm) for arm in arms)
+        self.table = {}
+        for comparison, map_func in arms:
+            self.table.setdefault(comparison.operand, map_func)
+
+    def __call__(self, subject):
+        if type(subject) in EqualityTable.KEY_TYPES:
+            return self.table.get(subject)
+        return find_map_func(self.arms, subject)
+
+    @staticmethod
+    def accepts(is_match):
+        if not isinstance(is_match, Comparison):
+            return False
+        if is_match.operator is not operator.eq:
+            return False
+        if type(is_match.operand) not in EqualityTable.KEY_TYPES:
+            return False
+        return is_match.operand == is_match.operand
+
+
+class RangeTable:
+    KEY_TYPES = frozenset((int, float))
+    OPERATORS = frozenset((
+        operator.lt, operator.le, operator.eq, operator.ge, operator.gt
+    ))
+
+    def __init__(self, arms):
+        self.arms = tuple(Arm(*arm) for arm in arms)
+        self.points = sorted(set(
+            comparison.operand for comparison, _ in arms
+        ))
+        self.regions = tuple(
+            find_map_func(self.arms, representative)
+            for representative in self.get_representatives()
+        )
 
-def match_type(*args):
-    return match(*[
-        (lambda value, types=types: isinstance(value, types), map_func)
-        for types, map_func in args
-    ])
+    def get_representatives(self):
+        points = [fractions.Fraction(point) for point in self.points]
+        yield points[0] - 1
+        for point, next_point in zip(points, points[1:]):
+            yield point
+            yield (point + next_point) / 2
+        yield points[-1]
+        yield points[-1] + 1
+
+    def __call__(self, subject):
+        if type(subject) not in RangeTable.KEY_TYPES or subject != subject:
+            return find_map_func(self.arms, subject)
+        index = bisect.bisect_left(self.points, subject)
+        if index < len(self.points) and self.points[index] == subject:
+            return self.regions[2 * index + 1]
+        return self.regions[2 * index]
+
+    @staticmethod
+    def accepts(is_match):
+        if not isinstance(is_match, Comparison):
+            return False
+        if is_match.operator not in RangeTable.OPERATORS:
+            return False
+        if type(is_match.operand) not in RangeTable.KEY_TYPES:
+            return False
+        return math.isfinite(is_match.operand)
+
+
+def compile_arms(args):
+    steps = []
+    run = []
+    tables = ()
+    for is_match, map_func in args:
+        accepted = tuple(
+            table for table in (EqualityTable, RangeTable)
+            if table.accepts(is_match)
+        )
+        shared = tuple(table for table in tables if table in accepted)
+        if run and shared:
+            run.append((is_match, map_func))
+            tables = shared
+            continue
+        steps.extend(compile_run(run, tables))
+        run = [(is_match, map_func)]
+        tables = accepted
+    steps.extend(compile_run(run, tables))
+    return tuple(steps)
+
+
+def compile_run(run, tables):
+    if len(run) > 1 and tables:
+        return (tables[0](run),)
+    return tuple(Arm(is_match, map_func) for is_match, map_func in run)
+
+
+class AdaptiveMatch(Match):
+    REORDER_INTERVAL = 1000
+
+    def __init__(self, *args, key=None):
+        super().__init__(*args, key=key)
+        self.state = (self.steps, [0] * len(self.steps))
+        self.calls = 0
+
+    def __call__(self, value):
+        steps, hits = self.state
+        subject = value if self.key is None or not steps else self.key(value)
+        for index, step in enumerate(steps):
+            map_func = step(subject)
+            if map_func is not None:
+                hits[index] += 1
+                break
+        else:
+            raise UnmatchedValueError(value)
+        self.calls += 1
+        if self.calls % AdaptiveMatch.REORDER_INTERVAL == 0:
+            self.reorder()
+        return map_func(value)
+
+    def reorder(self):
+        steps, hits = self.state
+        order = sorted(
+            range(len(steps)), key=lambda index: hits[index], reverse=True
+        )
+        self.state = (
+            tuple(steps[index] for index in order),
+            [hits[index] // 2 for index in order]
+        )
 
+    def order(self):
+        return tuple(
+            arm for step in self.state[0] for arm in get_step_arms(step)
+        )
 
-def match_length(*args):
-    return match(*[
-        (
-            lambda value, match_len=match_len: pipe(value, len, match_len),
-            map_func
+
+def get_step_arms(step):
+    if isinstance(step, Arm):
+        return ((step.is_match, step.map_func),)
+    return tuple((arm.is_match, arm.map_func) for arm in step.arms)
+
+
+def match(*args, exclusive=False):
+    if exclusive:
+        return AdaptiveMatch(*args)
+    return Match(*args)
+
+
+class TypeMatch:
+    def __init__(self, *args):
+        self.args = args
+        self.cache = {}
+
+    def __call__(self, value):
+        cls = type(value)
+        map_func = self.cache.get(cls)
+        if map_func is None:
+            map_func = self.resolve(value)
+            if value.__class__ is cls:
+                self.cache[cls] = map_func
+        return map_func(value)
+
+    def __reduce__(self):
+        return TypeMatch, self.args
+
+    def resolve(self, value):
+        return next(
+            (
+                map_func for types, map_func in self.args
+                if isinstance(value, types)
+            ),
+            raise_unmatched_value
         )
-        for match_len, map_func in args
-    ])
 
 
-class NamedArg:
-    NO_VALUE = object()
-    NO_DEFAULT = object()
+def raise_unmatched_value(value):
+    raise UnmatchedValueError(value)
 
-    def __init__(self, name, default=NO_DEFAULT, value=NO_VALUE):
-        self.name = name
-        self.default = default
-        self.value = value
 
-    def has_value(self):
-        return self.value != NamedArg.NO_VALUE
+def match_type(*args):
+    return TypeMatch(*args)
+
 
-    def has_value_or_default(self):
-        return self.has_value() or self.default != NamedArg.NO_DEFAULT
+def match_length(*args):
+    return Match(*args, key=len)
 
-    def value_or_default(self):
-        return self.value if self.has_value() else self.default
 
-    def with_value(self, value):
-        return NamedArg(self.name, self.default, value)
+class Signature:
+    NO_VALUE = object()
+    POSITIONAL_KINDS = (
+        inspect.Parameter.POSITIONAL_ONLY,
+        inspect.Parameter.POSITIONAL_OR_KEYWORD
+    )
+
+    def __init__(self, func):
+        parameters = inspect.signature(
+            func, follow_wrapped=False
+        ).parameters.values()
+        positional = [
+            parameter for parameter in parameters
+            if parameter.kind in Signature.POSITIONAL_KINDS
+        ]
+        keyword_only = [
+            parameter for parameter in parameters
+            if parameter.kind == inspect.Parameter.KEYWORD_ONLY
+        ]
+        named = positional + keyword_only
+        self.names = tuple(parameter.name for parameter in named)
+        self.defaults = tuple(
+            Signature.NO_VALUE if parameter.default is parameter.empty
+            else parameter.default
+            for parameter in named
+        )
+        self.positional_count = len(positional)
+        self.slots = {
+            parameter.name: index for index, parameter in enumerate(named)
+            if parameter.kind != inspect.Parameter.POSITIONAL_ONLY
+        }
+        self.required = tuple(
+            index for index, default in enumerate(self.defaults)
+            if default is Signature.NO_VALUE
+        )
+        self.min_args = next(
+            (
+                index + 1 for index in reversed(self.required)
+                if index < self.positional_count
+            ),
+            0
+        )
+        self.has_keyword_only = bool(keyword_only)
 
 
 class Args:
-    def __init__(self, named_args, list_args, keyword_args):
-        self.named_args = named_args
+    def __init__(self, signature, values, list_args, keyword_args):
+        self.signature = signature
+        self.values = values
         self.list_args = list_args
         self.keyword_args = keyword_args
 
     @classmethod
     def from_func(cls, func):
-        return pipe(
-            inspect.getargspec(func),
-            lambda argspec: pipe(
-                argspec.defaults if argspec.defaults is not None else (),
-                reversed,
-                list,
-                lambda rdefaults: pipe(
-                    argspec.args,
-                    reversed,
-                    lambda rargs: [
-                        NamedArg(name, rdefaults[index])
-                        if len(rdefaults) > index else NamedArg(name)
-                        for index, name in enumerate(rargs)
-                    ]
-                )
-            ),
-            reversed,
-            list,
-            lambda named_args: cls(named_args, list_args=(), keyword_args={})
-        )
-
-    def get_named_arg_index(self, is_match):
-        return pipe(
-            self.named_args,
-            lambda args:
-                (index for index, arg in enumerate(args) if is_match(arg)),
-            lambda iterator: next(iterator, None)
-        )
-
-    def apply_named_arg(self, index, value):
-        return pipe(
-            self.named_args.copy(),
-            tee(
-                lambda named_args: pipe(
-                    named_args.pop(index),
-                    lambda arg: named_args.insert(index, arg.with_value(value))
-                )
-            ),
-            lambda named_args: Args(
-                named_args, self.list_args, self.keyword_args.copy()
-            )
+        signature = Signature(func)
+        return cls(
+            signature,
+            (Signature.NO_VALUE,) * len(signature.names),
+            list_args=(),
+            keyword_args={}
         )
 
-    def apply_list_arg(self, value):
-        return pipe(
-            self.list_args + (value,),
-            lambda list_args: Args(
-                self.named_args.copy(), list_args, self.keyword_args.copy()
-            )
-        )
+    def apply(self, *args, **kwargs):
+        signature = self.signature
+        values = list(self.values)
+        list_args = self.list_args
+        index = 0
+        for position, value in enumerate(args):
+            while index < signature.positional_count:
+                if values[index] is Signature.NO_VALUE:
+                    break
+                index += 1
+            if index == signature.positional_count:
+                list_args += args[position:]
+                break
+            values[index] = value
+            index += 1
+        keyword_args = self.keyword_args
+        for name, value in kwargs.items():
+            slot = signature.slots.get(name)
+            if slot is not None:
+                values[slot] = value
+            else:
+                if keyword_args is self.keyword_args:
+                    keyword_args = keyword_args.copy()
+                keyword_args[name] = value
+        return Args(signature, tuple(values), list_args, keyword_args)
 
-    def apply_keyword_arg(self, name, value):
-        return pipe(
-            self.keyword_args.copy(),
-            tee(lambda keyword_args: keyword_args.update({name: value})),
-            lambda keyword_args: Args(
-                self.named_args.copy(), self.list_args, keyword_args
-            )
+    def all_present(self):
+        return all(
+            self.values[index] is not Signature.NO_VALUE
+            for index in self.signature.required
         )
 
-    def apply_arg(self, value):
-        return pipe(
-            self.get_named_arg_index(lambda arg: not arg.has_value()),
-            lambda index: (
-                self.apply_named_arg(index, value) if index is not None
-                else self.apply_list_arg(value)
+    def get_prefix(self):
+        if self.list_args or self.keyword_args:
+            return None
+        prefix = tuple(
+            itertools.takewhile(
+                lambda value: value is not Signature.NO_VALUE, self.values
             )
         )
+        is_prefix = all(
+            value is Signature.NO_VALUE
+            for value in self.values[len(prefix):]
+        )
+        if not is_prefix or len(prefix) > self.signature.positional_count:
+            return None
+        if self.signature.required and (
+            self.signature.required[-1] >= self.signature.positional_count
+        ):
+            return None
+        return prefix
 
-    def apply_kwarg(self, name, value):
-        return pipe(
-            self.get_named_arg_index(lambda arg: arg.name == name),
-            lambda index: (
-                self.apply_named_arg(index, value) if index is not None
-                else self.apply_keyword_arg(name, value)
+    def execute(self, func):
+        signature = self.signature
+        args = tuple(
+            default if value is Signature.NO_VALUE else value
+            for value, default in zip(
+                self.values[:signature.positional_count], signature.defaults
+            )
+        ) + self.list_args
+        if not signature.has_keyword_only:
+            return func(*args, **self.keyword_args)
+        keyword_args = self.keyword_args.copy()
+        keyword_args.update(
+            (name, value) for name, value in zip(
+                signature.names[signature.positional_count:],
+                self.values[signature.positional_count:]
             )
+            if value is not Signature.NO_VALUE
         )
+        return func(*args, **keyword_args)
 
-    def apply_args(self, *args):
-        return functools.reduce(
-            lambda args, value: args.apply_arg(value), args, self
+
+class Partial:
+    def __init__(self, func, applied_args=None, root=None, calls=()):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.applied_args = (
+            Args.from_func(func) if applied_args is None else applied_args
         )
+        self.root = self if root is None else root
+        self.calls = calls
+        self.prefix = self.applied_args.get_prefix()
+        if self.prefix is not None:
+            self.remaining = (
+                self.applied_args.signature.min_args - len(self.prefix)
+            )
 
-    def apply_kwargs(self, **kwargs):
-        return functools.reduce(
-            lambda args, name: args.apply_kwarg(name, kwargs[name]),
-            kwargs,
-            self
+    def __call__(self, *args, **kwargs):
+        prefix = self.prefix
+        if prefix is not None and not kwargs and len(args) >= self.remaining:
+            return self.func(*(prefix + args))
+        new_args = self.applied_args.apply(*args, **kwargs)
+        return (
+            new_args.execute(self.func) if new_args.all_present()
+            else Partial(
+                self.func, new_args, self.root, self.calls + ((args, kwargs),)
+            )
         )
 
-    def apply(self, *args, **kwargs):
-        return self.apply_args(*args).apply_kwargs(**kwargs)
+    def __get__(self, instance, owner):
+        return self if instance is None else types.MethodType(self, instance)
 
-    def all_present(self):
-        return all(arg.has_value_or_default() for arg in self.named_args)
+    def __reduce__(self):
+        if self.root is not self:
+            return apply_calls, (self.root, self.calls)
+        if find_global(self.__module__, self.__qualname__) is self:
+            return self.__qualname__
+        return Partial, (self.func,)
 
-    def named_arg_values(self):
-        return tuple(arg.value_or_default() for arg in self.named_args)
 
-    def execute(self, func):
-        args = self.named_arg_values() + self.list_args
-        return func(*args, **self.keyword_args)
+def find_global(module_name, qualname):
+    value = sys.modules.get(module_name)
+    for name in qualname.split('.'):
+        value = getattr(value, name, None)
+    return value
+
+
+def apply_calls(func, calls):
+    for args, kwargs in calls:
+        func = func(*args, **kwargs)
+    return func
 
 
 def partial(func, applied_args=None):
-    @functools.wraps(func)
-    def partial_func(*args, **kwargs):
-        return pipe(
-            Args.from_func(func) if applied_args is None else applied_args,
-            lambda existing_args: existing_args.apply(*args, **kwargs),
-            lambda new_args: (
-                new_args.execute(func) if new_args.all_present()
-                else partial(func, new_args)
-            )
+    return Partial(func, applied_args)
+
+
+class Pipeline:
+    CALL = 'call'
+    HANDLE = 'handle'
+    PUSH = 'push'
+    POP = 'pop'
+
+    def __init__(self, parts=()):
+        self.parts = tuple(parts)
+        self.length = sum(
+            len(part) if isinstance(part, Pipeline) else 1
+            for part in self.parts
+        )
+        self.flat_stages = None
+        self.funcs = None
+
+    def __len__(self):
+        return self.length
+
+    def __reduce__(self):
+        return Pipeline, (self.stages,)
+
+    @property
+    def stages(self):
+        if self.flat_stages is None:
+            self.flat_stages = self.flatten()
+        return self.flat_stages
+
+    def flatten(self):
+        stages = []
+        iterators = [iter(self.parts)]
+        while iterators:
+            part = next(iterators[-1], None)
+            if part is None:
+                iterators.pop()
+            elif not isinstance(part, Pipeline):
+                stages.append(part)
+            elif part.flat_stages is not None:
+                stages.extend(part.flat_stages)
+            else:
+                iterators.append(iter(part.parts))
+        return tuple(stages)
+
+    def prepare(self):
+        self.kinds = tuple(kind for kind, _, _ in self.stages)
+        self.is_simple = all(kind == Pipeline.CALL for kind in self.kinds)
+        self.handlers = self.get_handlers()
+        self.depths = self.get_depths()
+        self.funcs = tuple(func for _, func, _ in self.stages)
+        self.async_funcs = tuple(
+            getattr(func, 'run_async', None) for func in self.funcs
         )
-    return partial_func
 
+    @classmethod
+    def from_funcs(cls, *funcs):
+        return cls(part for func in funcs for part in cls.get_parts(func))
+
+    @staticmethod
+    def get_parts(func):
+        if isinstance(func, Track):
+            return Pipeline.get_parts(func.func)
+        if isinstance(func, Pipeline):
+            return (func,) if len(func) else ()
+        if func is identity:
+            return ()
+        return ((Pipeline.CALL, func, 0),)
+
+    def get_handlers(self):
+        handlers = [None] * len(self.stages)
+        for handler_index, (kind, _, span) in enumerate(self.stages):
+            if kind != Pipeline.HANDLE:
+                continue
+            index = handler_index - 1
+            while index >= handler_index - span:
+                if handlers[index] is None:
+                    handlers[index] = handler_index
+                    index -= 1
+                else:
+                    index = handlers[index] - self.stages[handlers[index]][2]
+                    index -= 1
+        return tuple(handlers)
+
+    def get_depths(self):
+        depths = []
+        depth = 0
+        for kind in self.kinds:
+            depth -= kind == Pipeline.POP
+            depths.append(depth)
+            depth += kind == Pipeline.PUSH
+        return tuple(depths)
 
-def compose(*funcs):
-    return functools.reduce(
-        lambda func1, func2: lambda arg: func2(func1(arg)), funcs, identity
+    def compose(self, *funcs):
+        return Pipeline.from_funcs(self, *funcs)
+
+    def handle(self, func):
+        return Pipeline((self, (Pipeline.HANDLE, func, len(self))))
+
+    def tee(self):
+        return Pipeline((
+            (Pipeline.PUSH, None, 0), self, (Pipeline.POP, None, 0)
+        )) if len(self) else self
+
+    def __call__(self, arg):
+        if self.funcs is None:
+            self.prepare()
+        if self.is_simple:
+            failure_class = Failure
+            for func in self.funcs:
+                arg = func(arg)
+                if arg.__class__ is failure_class:
+                    break
+            return arg
+        return self.run(arg)
+
+    def run(self, arg):
+        kinds, funcs = self.kinds, self.funcs
+        count = len(kinds)
+        saved = []
+        index = 0
+        failure = None
+        while True:
+            try:
+                if failure is not None:
+                    exception, failure = failure, None
+                    raise exception
+                while index < count:
+                    if index and arg.__class__ is Failure:
+                        index = self.handlers[index - 1]
+                        if index is None:
+                            return arg
+                        del saved[self.depths[index]:]
+                        arg = funcs[index](arg.exception)
+                        index += 1
+                        continue
+                    kind = kinds[index]
+                    if kind == Pipeline.CALL:
+                        arg = funcs[index](arg)
+                    elif kind == Pipeline.PUSH:
+                        saved.append(arg)
+                    elif kind == Pipeline.POP:
+                        arg = saved.pop()
+                    index += 1
+                return arg
+            except Exception as exception:
+                index = self.handlers[index]
+                if index is None:
+                    raise
+                del saved[self.depths[index]:]
+                try:
+                    arg = funcs[index](exception)
+                except Exception as handle_exception:
+                    failure = handle_exception
+                else:
+                    index += 1
+
+    async def run_async(self, arg):
+        if self.funcs is None:
+            self.prepare()
+        kinds, funcs = self.kinds, self.funcs
+        count = len(kinds)
+        saved = []
+        index = 0
+        failure = None
+        while True:
+            try:
+                if failure is not None:
+                    exception, failure = failure, None
+                    raise exception
+                while index < count:
+                    if index and arg.__class__ is Failure:
+                        index = self.handlers[index - 1]
+                        if index is None:
+                            return arg
+                        del saved[self.depths[index]:]
+                        arg = await call_async(funcs[index], arg.exception)
+                        index += 1
+                        continue
+                    kind = kinds[index]
+                    if kind == Pipeline.CALL:
+                        if self.async_funcs[index] is not None:
+                            arg = await self.async_funcs[index](arg)
+                        else:
+                            arg = funcs[index](arg)
+                            if inspect.isawaitable(arg):
+                                arg = await arg
+                    elif kind == Pipeline.PUSH:
+                        saved.append(arg)
+                    elif kind == Pipeline.POP:
+                        arg = saved.pop()
+                    index += 1
+                return arg
+            except Exception as exception:
+                index = self.handlers[index]
+                if index is None:
+                    raise
+                del saved[self.depths[index]:]
+                try:
+                    arg = await call_async(funcs[index], exception)
+                except Exception as handle_exception:
+                    failure = handle_exception
+                else:
+                    index += 1
+
+    def run_segment(self, arg, index, saved, stop):
+        if self.funcs is None:
+            self.prepare()
+        kinds, funcs = self.kinds, self.funcs
+        resume = 0 < index < stop and kinds[index] == Pipeline.HANDLE
+        failure = None
+        while True:
+            try:
+                if failure is not None:
+                    exception, failure = failure, None
+                    raise exception
+                if resume:
+                    resume = False
+                    arg = call_handler(funcs[index], arg)
+                    index += 1
+                while index < stop:
+                    if index and arg.__class__ is Failure:
+                        handler = self.handlers[index - 1]
+                        if handler is None or handler >= stop:
+                            return self.forward(arg, handler, saved)
+                        index = handler
+                        del saved[self.depths[index]:]
+                        arg = funcs[index](arg.exception)
+                        index += 1
+                        continue
+                    kind = kinds[index]
+                    if kind == Pipeline.CALL:
+                        arg = funcs[index](arg)
+                    elif kind == Pipeline.PUSH:
+                        saved.append(arg)
+                    elif kind == Pipeline.POP:
+                        arg = saved.pop()
+                    index += 1
+                return arg, index, saved
+            except Exception as exception:
+                handler = self.handlers[index]
+                if handler is None or handler >= stop:
+                    return self.forward(
+                        RaisedFailure(exception), handler, saved
+                    )
+                index = handler
+                del saved[self.depths[index]:]
+                try:
+                    arg = funcs[index](exception)
+                except Exception as handle_exception:
+                    failure = handle_exception
+                else:
+                    index += 1
+
+    def forward(self, failure, handler, saved):
+        if handler is None:
+            return failure, len(self.kinds), []
+        del saved[self.depths[handler]:]
+        return failure, handler, saved
+
+
+async def call_async(func, arg):
+    if hasattr(func, 'run_async'):
+        return await func.run_async(arg)
+    result = func(arg)
+    return await result if inspect.isawaitable(result) else result
+
+
+async def iterate_async(iterable):
+    if hasattr(iterable, '__aiter__'):
+        async for value in iterable:
+            yield value
+    else:
+        for value in iterable:
+            yield value
+
+
+class CompiledPipeline:
+    MAX_DEPTH = 8
+
+    def __init__(self, pipeline, is_async=False):
+        self.pipeline = pipeline
+        self.is_async = is_async
+
+    def __reduce__(self):
+        return compile_pipeline, (self.pipeline, self.is_async)
+
+
+def compile_pipeline(pipeline, is_async=False):
+    names = {
+        'Failure': Failure,
+        'isawaitable': inspect.isawaitable
+    }
+    lines = ['{0}def __call__(self, arg):'.format(
+        'async ' if is_async else ''
+    )]
+    generate_nodes(
+        get_nodes(pipeline.stages), pipeline.stages, lines, names,
+        is_async, indent=1, depth=0, regions=0
+    )
+    lines.append('    return arg')
+    exec(
+        compile('\n'.join(lines) + '\n', '<rail compiled>', 'exec'),
+        names
     )
+    compiled_class = type(
+        'CompiledPipeline', (CompiledPipeline,),
+        {'__call__': names['__call__']}
+    )
+    return compiled_class(pipeline, is_async)
+
+
+def get_nodes(stages):
+    nodes = []
+    for index, (kind, func, span) in enumerate(stages):
+        body = []
+        if kind == Pipeline.HANDLE:
+            start = index - span
+            while nodes and nodes[-1][3] >= start:
+                body.append(nodes.pop())
+            body.reverse()
+        else:
+            start = index
+        nodes.append((kind, func, tuple(body), start, index + 1))
+    return nodes
+
+
+def generate_nodes(
+    nodes, stages, lines, names, is_async, indent, depth, regions
+):
+    prefix = '    ' * indent
+    exit = 'continue' if regions else 'return arg'
+    previous_kind = None
+    for kind, func, body, start, stop in nodes:
+        if kind == Pipeline.PUSH:
+            if previous_kind != Pipeline.POP:
+                lines.append('{0}saved_{1} = arg'.format(prefix, depth))
+            depth += 1
+        elif kind == Pipeline.POP:
+            depth -= 1
+            lines.append('{0}arg = saved_{1}'.format(prefix, depth))
+        elif kind == Pipeline.HANDLE and (
+            regions < CompiledPipeline.MAX_DEPTH
+        ):
+            lines.append('{0}for _ in (None,):'.format(prefix))
+            lines.append('{0}    try:'.format(prefix))
+            if body:
+                generate_nodes(
+                    body, stages, lines, names, is_async,
+                    indent + 2, depth, regions + 1
+                )
+            else:
+                lines.append('{0}        pass'.format(prefix))
+            lines.append('{0}    except Exception as exception:'.format(
+                prefix
+            ))
+            generate_call(
+                func, 'exception', prefix + '        ', lines, names, is_async
+            )
+            lines.append('{0}    break'.format(prefix))
+            lines.append('{0}else:'.format(prefix))
+            generate_call(
+                func, 'arg.exception', prefix + '    ', lines, names,
+                is_async
+            )
+            lines.append('{0}if arg.__class__ is Failure:'.format(prefix))
+            lines.append('{0}    {1}'.format(prefix, exit))
+        elif func is not identity:
+            if kind == Pipeline.HANDLE:
+                func = Pipeline(stages[start:stop])
+            generate_call(func, 'arg', prefix, lines, names, is_async)
+            lines.append('{0}if arg.__class__ is Failure:'.format(prefix))
+            lines.append('{0}    {1}'.format(prefix, exit))
+        previous_kind = kind
+
+
+def generate_call(func, arg, prefix, lines, names, is_async):
+    name = 'func_{0}'.format(len(names))
+    if is_async and hasattr(func, 'run_async'):
+        names[name] = func.run_async
+        lines.append('{0}arg = await {1}({2})'.format(prefix, name, arg))
+        return
+    names[name] = func
+    lines.append('{0}arg = {1}({2})'.format(prefix, name, arg))
+    if is_async:
+        lines.append('{0}if isawaitable(arg):'.format(prefix))
+        lines.append('{0}    arg = await arg'.format(prefix))
+
+
+def compose(*funcs):
+    pipeline = Pipeline.from_funcs(*funcs)
+    if not len(pipeline):
+        return identity
+    if len(pipeline) == 1 and pipeline.stages[0][0] == Pipeline.CALL:
+        return pipeline.stages[0][1]
+    return pipeline
 
 
 def pipe(value, *funcs):
-    func = compose(*funcs)
-    return func(value)
+    for func in funcs:
+        value = func(value)
+        if value.__class__ is Failure:
+            break
+    return value
 
 
 def tee(*funcs):
-    return lambda arg: pipe(
-        arg,
-        compose(*funcs),
-        lambda _: arg
-    )
+    return Pipeline.from_funcs(*funcs).tee()
 
 
 @partial
@@ -232,50 +887,2060 @@ def call_with(value, func):
 
 
 @partial
+def map_(func, iterable):
+    return map(func, iterable)
+
+
+@partial
+def filter_(predicate, iterable):
+    return filter(predicate, iterable)
+
+
+@partial
+def flat_map(func, iterable):
+    return itertools.chain.from_iterable(map(func, iterable))
+
+
+@partial
+def chunk(size, iterable):
+    if size < 1:
+        raise ValueError('size must be at least 1')
+    iterator = iter(iterable)
+    return iter(lambda: tuple(itertools.islice(iterator, size)), ())
+
+
+@partial
+def window(size, iterable):
+    if size < 1:
+        raise ValueError('size must be at least 1')
+    return iterate_windows(size, iter(iterable))
+
+
+def iterate_windows(size, iterator):
+    values = collections.deque(itertools.islice(iterator, size - 1), size)
+    for value in iterator:
+        values.append(value)
+        yield tuple(values)
+
+
+@partial
+def scan(func, initial, iterable):
+    return iterate_scan(func, initial, iterable)
+
+
+def iterate_scan(func, value, iterable):
+    for item in iterable:
+        value = func(value, item)
+        yield value
+
+
+def read_records(path, delimiter=b'\n', width=None, start=0, stop=None):
+    check_record_format(delimiter, width)
+    return iterate_records(path, delimiter, width, start, stop)
+
+
+def iterate_records(path, delimiter, width, start, stop):
+    with open(path, 'rb') as file:
+        if not os.fstat(file.fileno()).st_size:
+            return
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapping, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(mapping)
+    stop = len(mapping) if stop is None else min(stop, len(mapping))
+    try:
+        if width is not None:
+            for offset in range(start, stop, width):
+                yield view[offset:min(offset + width, stop)]
+            return
+        find = mapping.find
+        offset = start
+        while offset < stop:
+            end = find(delimiter, offset, stop)
+            if end < 0:
+                yield view[offset:stop]
+                return
+            yield view[offset:end]
+            offset = end + len(delimiter)
+    finally:
+        view.release()
+        try:
+            mapping.close()
+        except BufferError:
+            pass
+
+
+def split_file(path, parts, delimiter=b'\n', width=None):
+    check_record_format(delimiter, width)
+    if parts < 1:
+        raise ValueError('parts must be at least 1')
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if not size:
+            return []
+        with mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapping:
+            bounds = [0]
+            for part in range(1, parts):
+                offset = size * part // parts
+                if width is not None:
+                    offset -= offset % width
+                elif is_self_overlapping(delimiter):
+                    offset = find_record_start(
+                        mapping, delimiter, bounds[-1], offset
+                    )
+                else:
+                    end = mapping.find(
+                        delimiter, max(offset - len(delimiter), 0)
+                    )
+                    offset = size if end < 0 else end + len(delimiter)
+                if offset > bounds[-1]:
+                    bounds.append(min(offset, size))
+    bounds.append(size)
+    return [
+        (start, stop) for start, stop in zip(bounds, bounds[1:])
+        if start < stop
+    ]
+
+
+def is_self_overlapping(delimiter):
+    return any(
+        delimiter[:length] == delimiter[-length:]
+        for length in range(1, len(delimiter))
+    )
+
+
+def find_record_start(mapping, delimiter, start, offset):
+    while start < offset:
+        end = mapping.find(delimiter, start)
+        if end < 0:
+            return len(mapping)
+        start = end + len(delimiter)
+    return start
+
+
+def check_record_format(delimiter, width):
+    if width is None and not delimiter:
+        raise ValueError('delimiter must not be empty')
+    if width is not None and width < 1:
+        raise ValueError('width must be at least 1')
+
+
+class Comparison:
+    def __init__(self, operator, operand):
+        self.operator = operator
+        self.operand = operand
+
+    def __call__(self, value1):
+        return self.operator(value1, self.operand)
+
+
+class Comparator:
+    def __init__(self, func, operator):
+        functools.update_wrapper(self, func)
+        self.operator = operator
+        self.partial = partial(compare)(operator)
+
+    def __call__(self, *args, **kwargs):
+        if not kwargs and len(args) == 1:
+            return Comparison(self.operator, args[0])
+        if not kwargs and len(args) == 2:
+            return self.operator(args[1], args[0])
+        if not args and kwargs.keys() == {'value2'}:
+            return Comparison(self.operator, kwargs['value2'])
+        return self.partial(*args, **kwargs)
+
+    def __reduce__(self):
+        return self.__qualname__
+
+
+def comparator(operator):
+    return functools.partial(Comparator, operator=operator)
+
+
+def compare(operator, value2, value1):
+    return operator(value1, value2)
+
+
+@comparator(operator.lt)
 def lt(value2, value1):
     return value1 < value2
 
 
-@partial
+@comparator(operator.le)
 def le(value2, value1):
     return value1 <= value2
 
 
-@partial
+@comparator(operator.eq)
 def eq(value2, value1):
     return value1 == value2
 
 
-@partial
+@comparator(operator.ne)
 def ne(value2, value1):
     return value1 != value2
 
 
-@partial
+@comparator(operator.gt)
 def gt(value2, value1):
     return value1 > value2
 
 
-@partial
+@comparator(operator.ge)
 def ge(value2, value1):
     return value1 >= value2
 
 
+class StageMetrics:
+    BUCKETS = (
+        0.000001, 0.0000025, 0.000005,
+        0.00001, 0.000025, 0.00005,
+        0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total_seconds = 0.0
+        self.bucket_counts = [0] * (len(StageMetrics.BUCKETS) + 1)
+        self.exceptions = collections.Counter()
+
+    def __reduce__(self):
+        return StageMetrics, (self.name,)
+
+    def record(self, seconds):
+        index = bisect.bisect_left(StageMetrics.BUCKETS, seconds)
+        with self.lock:
+            self.count += 1
+            self.total_seconds += seconds
+            self.bucket_counts[index] += 1
+
+    def record_exception(self, exception):
+        with self.lock:
+            self.exceptions[type(exception).__name__] += 1
+
+    def percentile(self, fraction):
+        rank = fraction * self.count
+        cumulative = 0
+        for bound, count in zip(StageMetrics.BUCKETS, self.bucket_counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return math.inf
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'total_seconds': self.total_seconds,
+                'p50_seconds': self.percentile(0.5),
+                'p90_seconds': self.percentile(0.9),
+                'p99_seconds': self.percentile(0.99),
+                'buckets': dict(zip(
+                    StageMetrics.BUCKETS + (math.inf,),
+                    itertools.accumulate(self.bucket_counts)
+                )),
+                'exceptions': dict(self.exceptions)
+            }
+
+
+class Metrics:
+    def __init__(self, prefix='rail'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def __reduce__(self):
+        return Metrics, (self.prefix,), {'stages': self.stages}
+
+    def stage(self, name):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = StageMetrics(name)
+            return self.stages[name]
+
+    def snapshot(self):
+        with self.lock:
+            stages = list(self.stages.values())
+        return {stage.name: stage.snapshot() for stage in stages}
+
+    def to_prometheus(self):
+        prefix = self.prefix
+        snapshot = self.snapshot()
+        lines = ['# TYPE {0}_stage_seconds histogram'.format(prefix)]
+        for name, stage in snapshot.items():
+            label = prometheus_label('stage', name)
+            lines.extend(
+                '{0}_stage_seconds_bucket{{{1},le="{2}"}} {3}'.format(
+                    prefix, label,
+                    '+Inf' if bound == math.inf else repr(bound), count
+                )
+                for bound, count in stage['buckets'].items()
+            )
+            lines.append('{0}_stage_seconds_sum{{{1}}} {2!r}'.format(
+                prefix, label, stage['total_seconds']
+            ))
+            lines.append('{0}_stage_seconds_count{{{1}}} {2}'.format(
+                prefix, label, stage['count']
+            ))
+        lines.append(
+            '# TYPE {0}_stage_exceptions_total counter'.format(prefix)
+        )
+        for name, stage in snapshot.items():
+            label = prometheus_label('stage', name)
+            lines.extend(
+                '{0}_stage_exceptions_total{{{1},{2}}} {3}'.format(
+                    prefix, label, prometheus_label('exception', exception),
+                    count
+                )
+                for exception, count in sorted(stage['exceptions'].items())
+            )
+        return '\n'.join(lines) + '\n'
+
+
+def prometheus_label(name, value):
+    return '{0}="{1}"'.format(
+        name,
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n'
+        )
+    )
+
+
+class MeasuredStage:
+    def __init__(self, metrics, func):
+        self.metrics = metrics
+        self.func = func
+
+    def __reduce__(self):
+        return MeasuredStage, (self.metrics, self.func)
+
+    def __call__(self, arg):
+        start = time.perf_counter()
+        try:
+            result = self.func(arg)
+        except Exception as exception:
+            self.metrics.record_exception(exception)
+            raise
+        finally:
+            self.metrics.record(time.perf_counter() - start)
+        if result.__class__ is Failure:
+            self.metrics.record_exception(result.exception)
+        return result
+
+    async def run_async(self, arg):
+        start = time.perf_counter()
+        try:
+            result = await call_async(self.func, arg)
+        except Exception as exception:
+            self.metrics.record_exception(exception)
+            raise
+        finally:
+            self.metrics.record(time.perf_counter() - start)
+        if result.__class__ is Failure:
+            self.metrics.record_exception(result.exception)
+        return result
+
+
+class Cache:
+    NO_ENTRY = object()
+
+    def __init__(
+        self, func, maxsize=128, ttl=None, key=None, cache_failures=False
+    ):
+        self.func = func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = key
+        self.cache_failures = cache_failures
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.uncacheable = 0
+
+    def __call__(self, arg):
+        key = self.get_key(arg)
+        entry = self.lookup(key)
+        if entry is not Cache.NO_ENTRY:
+            return entry
+        try:
+            result = self.func(arg)
+        except Exception as exception:
+            if not self.cache_failures:
+                raise
+            result = Failure(exception.with_traceback(None))
+        if result.__class__ is not Failure or self.cache_failures:
+            self.store(key, result)
+        return result
+
+    async def run_async(self, arg):
+        key = self.get_key(arg)
+        entry = self.lookup(key)
+        if entry is not Cache.NO_ENTRY:
+            return entry
+        try:
+            result = await call_async(self.func, arg)
+        except Exception as exception:
+            if not self.cache_failures:
+                raise
+            result = Failure(exception.with_traceback(None))
+        if result.__class__ is not Failure or self.cache_failures:
+            self.store(key, result)
+        return result
+
+    def __reduce__(self):
+        return Cache, (
+            self.func, self.maxsize, self.ttl, self.key, self.cache_failures
+        )
+
+    def get_key(self, arg):
+        key = arg if self.key is None else self.key(arg)
+        try:
+            hash(key)
+        except TypeError:
+            with self.lock:
+                self.uncacheable += 1
+            return Cache.NO_ENTRY
+        return key
+
+    def lookup(self, key):
+        if key is Cache.NO_ENTRY:
+            return Cache.NO_ENTRY
+        with self.lock:
+            expires, entry = self.entries.get(key, (None, Cache.NO_ENTRY))
+            if entry is not Cache.NO_ENTRY and (
+                expires is not None and expires <= time.monotonic()
+            ):
+                del self.entries[key]
+                self.expirations += 1
+                entry = Cache.NO_ENTRY
+            if entry is Cache.NO_ENTRY:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return entry
+
+    def store(self, key, entry):
+        if key is Cache.NO_ENTRY:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[key] = (expires, entry)
+            self.entries.move_to_end(key)
+            if self.maxsize is None:
+                return
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'uncacheable': self.uncacheable,
+                'size': len(self.entries),
+                'maxsize': self.maxsize
+            }
+
+
+class Coalesce:
+    NO_KEY = object()
+
+    def __init__(self, func, key=None):
+        self.func = func
+        self.key = key
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.tasks = weakref.WeakKeyDictionary()
+        self.calls = 0
+        self.executions = 0
+
+    def __call__(self, arg):
+        key = self.get_key(arg)
+        if key is Coalesce.NO_KEY:
+            return self.func(arg)
+        with self.lock:
+            self.calls += 1
+            future = self.futures.get(key)
+            if future is not None:
+                is_leader = False
+            else:
+                is_leader = True
+                future = self.futures[key] = concurrent.futures.Future()
+                self.executions += 1
+        if not is_leader:
+            return future.result()
+        try:
+            result = self.func(arg)
+        except BaseException as exception:
+            future.set_exception(exception)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.futures[key]
+
+    async def run_async(self, arg):
+        key = self.get_key(arg)
+        if key is Coalesce.NO_KEY:
+            return await call_async(self.func, arg)
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            self.calls += 1
+            tasks = self.tasks.get(loop)
+            if tasks is None:
+                tasks = self.tasks[loop] = {}
+            task = tasks.get(key)
+            if task is None:
+                task = tasks[key] = asyncio.ensure_future(
+                    call_async(self.func, arg)
+                )
+                task.add_done_callback(
+                    functools.partial(self.finish, tasks, key)
+                )
+                self.executions += 1
+        return await asyncio.shield(task)
+
+    def __reduce__(self):
+        return Coalesce, (self.func, self.key)
+
+    def get_key(self, arg):
+        key = arg if self.key is None else self.key(arg)
+        try:
+            hash(key)
+        except TypeError:
+            return Coalesce.NO_KEY
+        return key
+
+    def finish(self, tasks, key, task):
+        with self.lock:
+            if tasks.get(key) is task:
+                del tasks[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'executions': self.executions,
+                'coalesced': self.calls - self.executions,
+                'in_flight': len(self.futures) + sum(
+                    len(tasks) for tasks in self.tasks.values()
+                )
+            }
+
+
+class Batch:
+    def __init__(self, func, max_size=100, max_wait=0.005):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.func = func
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.pending = None
+        self.async_pending = weakref.WeakKeyDictionary()
+        self.wait = StageMetrics('batch')
+        self.batch_sizes = collections.Counter()
+
+    def __call__(self, arg):
+        future = concurrent.futures.Future()
+        with self.lock:
+            batch = self.pending
+            is_leader = batch is None
+            if is_leader:
+                batch = self.pending = PendingBatch(threading.Event())
+            batch.add(arg, future)
+            if len(batch.values) >= self.max_size:
+                self.pending = None
+                batch.full.set()
+        if is_leader:
+            batch.full.wait(self.max_wait)
+            with self.lock:
+                if self.pending is batch:
+                    self.pending = None
+            self.execute(batch)
+        return future.result()
+
+    async def run_async(self, arg):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            batch = self.async_pending.get(loop)
+            if batch is None:
+                batch = self.async_pending[loop] = PendingBatch(None)
+                batch.full = loop.call_later(
+                    self.max_wait, self.flush_async, loop, batch
+                )
+            batch.add(arg, future)
+            is_full = len(batch.values) >= self.max_size
+        if is_full:
+            self.flush_async(loop, batch)
+        return await future
+
+    def __reduce__(self):
+        return Batch, (self.func, self.max_size, self.max_wait)
+
+    def execute(self, batch):
+        self.record(batch)
+        try:
+            results = self.get_results(batch, self.func(batch.values))
+        except BaseException as exception:
+            for future in batch.futures:
+                future.set_exception(exception)
+        else:
+            for future, result in zip(batch.futures, results):
+                future.set_result(result)
+
+    def flush_async(self, loop, batch):
+        with self.lock:
+            if self.async_pending.get(loop) is not batch:
+                return
+            del self.async_pending[loop]
+        batch.full.cancel()
+        asyncio.ensure_future(self.execute_async(batch))
+
+    async def execute_async(self, batch):
+        self.record(batch)
+        try:
+            results = self.get_results(
+                batch, await call_async(self.func, batch.values)
+            )
+        except Exception as exception:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(exception)
+        else:
+            for future, result in zip(batch.futures, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            for future in batch.futures:
+                future.cancel()
+
+    def get_results(self, batch, results):
+        results = list(results)
+        if len(results) != len(batch.values):
+            raise ValueError(
+                'batch function returned {0} results for {1} values'.format(
+                    len(results), len(batch.values)
+                )
+            )
+        return results
+
+    def record(self, batch):
+        now = time.perf_counter()
+        for start in batch.starts:
+            self.wait.record(now - start)
+        with self.lock:
+            self.batch_sizes[len(batch.values)] += 1
+
+    def stats(self):
+        with self.lock:
+            batch_sizes = dict(self.batch_sizes)
+        calls = sum(size * count for size, count in batch_sizes.items())
+        batches = sum(batch_sizes.values())
+        with self.wait.lock:
+            return {
+                'calls': calls,
+                'batches': batches,
+                'mean_batch_size': calls / batches if batches else 0.0,
+                'batch_sizes': batch_sizes,
+                'mean_wait_seconds': (
+                    self.wait.total_seconds / self.wait.count
+                    if self.wait.count else 0.0
+                ),
+                'p99_wait_seconds': self.wait.percentile(0.99)
+            }
+
+
+class PendingBatch:
+    def __init__(self, full):
+        self.full = full
+        self.values = []
+        self.futures = []
+        self.starts = []
+
+    def add(self, value, future):
+        self.values.append(value)
+        self.futures.append(future)
+        self.starts.append(time.perf_counter())
+
+
+class Pool:
+    NO_RESOURCE = object()
+
+    def __init__(self, create, size=8, timeout=None, check=None, close=None):
+        if size < 1:
+            raise ValueError('size must be at least 1')
+        self.create = create
+        self.size = size
+        self.timeout = timeout
+        self.check = check
+        self.close = close
+        self.lock = threading.Lock()
+        self.leased = 0
+        self.waiters = collections.deque()
+        self.idle = collections.deque()
+        self.async_idle = weakref.WeakKeyDictionary()
+        self.in_use = 0
+        self.created = 0
+        self.discarded = 0
+        self.timeouts = 0
+
+    def acquire(self):
+        self.acquire_slot()
+        try:
+            while True:
+                resource = self.pop_idle(None)
+                if resource is Pool.NO_RESOURCE:
+                    resource = self.add_created(self.create())
+                    break
+                if self.check is None or self.check(resource):
+                    break
+                self.discard(resource)
+                if self.close is not None:
+                    self.close(resource)
+        except BaseException:
+            self.release_slot()
+            raise
+        return self.lend(resource)
+
+    def release(self, resource):
+        try:
+            if not self.push_idle(None, resource) and self.close is not None:
+                self.close(resource)
+        finally:
+            self.release_slot()
+
+    async def acquire_async(self):
+        await self.acquire_slot_async()
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                resource = self.pop_idle(loop)
+                if resource is Pool.NO_RESOURCE:
+                    resource = self.add_created(
+                        await resolve(self.create())
+                    )
+                    break
+                if self.check is None or await resolve(self.check(resource)):
+                    break
+                self.discard(resource)
+                if self.close is not None:
+                    await resolve(self.close(resource))
+        except BaseException:
+            self.release_slot()
+            raise
+        return self.lend(resource)
+
+    async def release_async(self, resource):
+        loop = asyncio.get_running_loop()
+        try:
+            if not self.push_idle(loop, resource) and self.close is not None:
+                await resolve(self.close(resource))
+        finally:
+            self.release_slot()
+
+    def __reduce__(self):
+        return Pool, (
+            self.create, self.size, self.timeout, self.check, self.close
+        )
+
+    def acquire_slot(self):
+        with self.lock:
+            if self.take_slot():
+                return
+            event = threading.Event()
+            wake = functools.partial(wake_thread, event)
+            self.waiters.append(wake)
+        if not event.wait(self.timeout):
+            self.cancel_wait(wake)
+
+    async def acquire_slot_async(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.take_slot():
+                return
+            future = loop.create_future()
+            wake = functools.partial(wake_task, loop, future)
+            self.waiters.append(wake)
+        try:
+            await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.cancel_wait(wake)
+        except BaseException:
+            with self.lock:
+                is_waiting = wake in self.waiters
+                if is_waiting:
+                    self.waiters.remove(wake)
+            if not is_waiting:
+                self.release_slot()
+            raise
+
+    def take_slot(self):
+        if self.leased < self.size and not self.waiters:
+            self.leased += 1
+            return True
+        return False
+
+    def cancel_wait(self, wake):
+        with self.lock:
+            if wake not in self.waiters:
+                return
+            self.waiters.remove(wake)
+        raise self.get_timeout_error()
+
+    def release_slot(self):
+        while True:
+            with self.lock:
+                if not self.waiters:
+                    self.leased -= 1
+                    return
+                wake = self.waiters.popleft()
+            if wake():
+                return
+
+    def get_idle(self, owner):
+        if owner is None:
+            return self.idle
+        idle = self.async_idle.get(owner)
+        if idle is None:
+            idle = self.async_idle[owner] = collections.deque()
+        return idle
+
+    def pop_idle(self, owner):
+        with self.lock:
+            idle = self.get_idle(owner)
+            return idle.pop() if idle else Pool.NO_RESOURCE
+
+    def lend(self, resource):
+        with self.lock:
+            self.in_use += 1
+        return resource
+
+    def push_idle(self, owner, resource):
+        with self.lock:
+            self.in_use -= 1
+            idle = self.get_idle(owner)
+            if len(idle) >= self.size:
+                self.discarded += 1
+                return False
+            idle.append(resource)
+            return True
+
+    def add_created(self, resource):
+        with self.lock:
+            self.created += 1
+        return resource
+
+    def discard(self, resource):
+        with self.lock:
+            self.discarded += 1
+
+    def get_timeout_error(self):
+        with self.lock:
+            self.timeouts += 1
+        return TimeoutError(
+            'no pooled resource available after {0} seconds'.format(
+                self.timeout
+            )
+        )
+
+    def clear(self):
+        with self.lock:
+            resources = list(self.idle)
+            self.idle.clear()
+        if self.close is not None:
+            for resource in resources:
+                self.close(resource)
+
+    async def clear_async(self):
+        with self.lock:
+            idle = self.get_idle(asyncio.get_running_loop())
+            resources = list(idle)
+            idle.clear()
+        if self.close is not None:
+            for resource in resources:
+                await resolve(self.close(resource))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'created': self.created,
+                'discarded': self.discarded,
+                'idle': len(self.idle) + sum(
+                    len(idle) for idle in self.async_idle.values()
+                ),
+                'in_use': self.in_use,
+                'timeouts': self.timeouts
+            }
+
+
+def wake_thread(event):
+    event.set()
+    return True
+
+
+def wake_task(loop, future):
+    try:
+        loop.call_soon_threadsafe(set_future_result, future)
+    except RuntimeError:
+        return False
+    return True
+
+
+def set_future_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Pooled:
+    def __init__(self, pool, func):
+        self.pool = pool
+        self.func = func
+
+    def __call__(self, arg):
+        resource = self.pool.acquire()
+        try:
+            return self.func(resource, arg)
+        finally:
+            self.pool.release(resource)
+
+    async def run_async(self, arg):
+        resource = await self.pool.acquire_async()
+        try:
+            return await resolve(self.func(resource, arg))
+        finally:
+            await self.pool.release_async(resource)
+
+
+async def resolve(result):
+    return await result if inspect.isawaitable(result) else result
+
+
+FailureRecord = collections.namedtuple(
+    'FailureRecord', ('type', 'message', 'stage', 'key', 'traceback')
+)
+
+
+class FailureLog:
+    MAX_MESSAGE_LENGTH = 200
+
+    def __init__(
+        self, key=None, tracebacks_per_type=1, sample_rate=0.0,
+        memory_limit=1024 * 1024, spill_path=None
+    ):
+        self.key = key
+        self.tracebacks_per_type = tracebacks_per_type
+        self.sample_rate = sample_rate
+        self.memory_limit = memory_limit
+        self.spill_path = spill_path
+        self.lock = threading.Lock()
+        self.records = []
+        self.memory = 0
+        self.counts = collections.Counter()
+        self.spilled = 0
+        self.dropped = 0
+
+    def __call__(self, value, exception):
+        type_name = type(exception).__name__
+        with self.lock:
+            self.counts[type_name] += 1
+            is_traced = self.counts[type_name] <= self.tracebacks_per_type
+        if not is_traced:
+            is_traced = random.random() < self.sample_rate
+        message = str(exception)
+        if len(message) > FailureLog.MAX_MESSAGE_LENGTH:
+            message = message[:FailureLog.MAX_MESSAGE_LENGTH - 3] + '...'
+        record = FailureRecord(
+            type_name,
+            message,
+            get_stage_name(exception.__traceback__),
+            reprlib.repr(value) if self.key is None else self.key(value),
+            ''.join(traceback.format_exception(
+                type(exception), exception, exception.__traceback__
+            )) if is_traced and exception.__traceback__ is not None else None
+        )
+        size = sys.getsizeof(record) + sum(map(sys.getsizeof, record))
+        with self.lock:
+            if self.memory + size <= self.memory_limit:
+                self.records.append(record)
+                self.memory += size
+            elif self.spill_path is not None:
+                mode = 'a' if self.spilled else 'w'
+                with open(self.spill_path, mode) as file:
+                    file.write(
+                        json.dumps(record._asdict(), default=repr) + '\n'
+                    )
+                self.spilled += 1
+            else:
+                self.dropped += 1
+
+    def __iter__(self):
+        with self.lock:
+            records = list(self.records)
+            spilled = self.spilled
+        yield from records
+        if spilled:
+            with open(self.spill_path) as file:
+                for line in itertools.islice(file, spilled):
+                    yield FailureRecord(**json.loads(line))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'counts': dict(self.counts),
+                'records': len(self.records),
+                'memory': self.memory,
+                'spilled': self.spilled,
+                'dropped': self.dropped
+            }
+
+
+def get_stage_name(tb):
+    stage = None
+    in_rail = False
+    while tb is not None:
+        is_rail = tb.tb_frame.f_globals.get('__name__') == __name__
+        if in_rail and not is_rail:
+            return tb.tb_frame.f_code.co_name
+        if not is_rail:
+            stage = tb.tb_frame.f_code.co_name
+        in_rail = in_rail or is_rail
+        tb = tb.tb_next
+    return stage
+
+
+class Vectorized:
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, arg):
+        return self.func(arg)
+
+
+def vectorized(func):
+    return Vectorized(func)
+
+
+class BatchRun:
+    def __init__(self, pipeline, batch, concatenate):
+        if pipeline.funcs is None:
+            pipeline.prepare()
+        self.pipeline = pipeline
+        self.batch = batch
+        self.concatenate = concatenate
+        self.outputs = []
+
+    def run(self):
+        count = len(self.pipeline.kinds)
+        pieces = [(0, 0, self.batch, [])] if len(self.batch) else []
+        while pieces:
+            offset, index, data, saved = pieces.pop()
+            if index == count:
+                self.outputs.append((offset, data))
+                continue
+            kind, func = self.pipeline.kinds[index], self.pipeline.funcs[index]
+            if kind == Pipeline.PUSH:
+                pieces.append((offset, index + 1, data, saved + [data]))
+            elif kind == Pipeline.POP:
+                pieces.append((offset, index + 1, saved[-1], saved[:-1]))
+            elif kind == Pipeline.HANDLE:
+                pieces.append((offset, index + 1, data, saved))
+            elif isinstance(func, Vectorized):
+                pieces.extend(reversed(self.apply_vectorized(
+                    func, index, offset, data, saved
+                )))
+            else:
+                pieces.extend(reversed(self.apply_scalar(
+                    func, index, offset, data, saved
+                )))
+        self.outputs.sort(key=lambda output: output[0])
+        return self.outputs
+
+    def apply_vectorized(self, func, index, offset, data, saved):
+        try:
+            result = func.func(data)
+        except Exception as exception:
+            result = RaisedFailure(exception)
+        if not is_failure(result):
+            if len(result) != len(data):
+                raise ValueError(
+                    'vectorized stage returned {0} values for {1}'.format(
+                        len(result), len(data)
+                    )
+                )
+            return [(offset, index + 1, result, saved)]
+        if len(data) == 1:
+            return self.fail(result, index, offset, saved)
+        middle = len(data) // 2
+        return [
+            (
+                offset, index, data[:middle],
+                [values[:middle] for values in saved]
+            ),
+            (
+                offset + middle, index, data[middle:],
+                [values[middle:] for values in saved]
+            )
+        ]
+
+    def apply_scalar(self, func, index, offset, data, saved):
+        pieces = []
+        results = []
+        start = 0
+        for position in range(len(data) + 1):
+            if position < len(data):
+                try:
+                    result = func(data[position])
+                except Exception as exception:
+                    result = RaisedFailure(exception)
+                if not is_failure(result):
+                    results.append(result)
+                    continue
+            if results:
+                pieces.append((
+                    offset + start, index + 1, self.concatenate([results]),
+                    [values[start:position] for values in saved]
+                ))
+                results = []
+            if position < len(data):
+                pieces.extend(self.fail(
+                    result, index, offset + position,
+                    [values[position:position + 1] for values in saved]
+                ))
+                start = position + 1
+        return pieces
+
+    def fail(self, failure, index, offset, saved):
+        handler = self.pipeline.handlers[index]
+        while handler is not None:
+            saved = saved[:self.pipeline.depths[handler]]
+            try:
+                result = call_handler(self.pipeline.funcs[handler], failure)
+            except Exception as exception:
+                result = RaisedFailure(exception)
+            if not is_failure(result):
+                return [(
+                    offset, handler + 1, self.concatenate([[result]]), saved
+                )]
+            failure = result
+            handler = self.pipeline.handlers[handler]
+        self.outputs.append((offset, failure))
+        return []
+
+
+def concatenate_pieces(pieces):
+    if len(pieces) == 1:
+        return pieces[0]
+    return list(itertools.chain.from_iterable(pieces))
+
+
+def call_handler(func, failure):
+    if failure.__class__ is not RaisedFailure:
+        return func(failure.exception)
+    try:
+        raise failure.exception
+    except Exception:
+        return func(failure.exception)
+
+
+def call_failure(func, value, failure):
+    if failure.__class__ is not RaisedFailure:
+        return func(value, failure.exception)
+    try:
+        raise failure.exception
+    except Exception:
+        return func(value, failure.exception)
+
+
+class Timeout:
+    def __init__(self, func, seconds, workers=32):
+        self.func = func
+        self.seconds = seconds
+        self.workers = StageWorkers(workers)
+
+    def __call__(self, arg):
+        deadline = time.monotonic() + self.seconds
+        future = self.workers.submit(self.func, arg, self.seconds)
+        if future is None or not concurrent.futures.wait(
+            (future,), max(deadline - time.monotonic(), 0)
+        ).done:
+            raise self.get_timeout_error()
+        return future.result()
+
+    async def run_async(self, arg):
+        task = asyncio.ensure_future(call_async(self.func, arg))
+        if not (await asyncio.wait((task,), timeout=self.seconds))[0]:
+            task.cancel()
+            raise self.get_timeout_error()
+        return task.result()
+
+    def __reduce__(self):
+        return Timeout, (self.func, self.seconds, self.workers.size)
+
+    def get_timeout_error(self):
+        return TimeoutError(
+            'stage timed out after {0} seconds'.format(self.seconds)
+        )
+
+
+class Hedge:
+    MIN_SAMPLES = 20
+
+    def __init__(
+        self, func, delay=None, percentile=0.95, attempts=2, workers=32
+    ):
+        self.func = func
+        self.delay = delay
+        self.percentile = percentile
+        self.attempts = attempts
+        self.workers = StageWorkers(workers)
+        self.latency = StageMetrics('hedge')
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def __call__(self, arg):
+        delay = self.get_delay()
+        futures = [self.workers.submit(self.measure, arg)]
+        pending = set(futures)
+        failed = None
+        while pending:
+            can_hedge = delay is not None and len(futures) < self.attempts
+            done, pending = concurrent.futures.wait(
+                pending, delay if can_hedge else None,
+                concurrent.futures.FIRST_COMPLETED
+            )
+            if not done:
+                future = self.workers.submit(self.measure, arg, 0)
+                if future is None:
+                    delay = None
+                    continue
+                futures.append(future)
+                pending.add(future)
+                continue
+            for future in done:
+                if is_successful(future):
+                    self.count(futures, future)
+                    return future.result()
+                if failed is None:
+                    failed = future
+        self.count(futures, failed)
+        return failed.result()
+
+    async def run_async(self, arg):
+        delay = self.get_delay()
+        tasks = [asyncio.ensure_future(self.measure_async(arg))]
+        pending = set(tasks)
+        failed = None
+        try:
+            while pending:
+                can_hedge = delay is not None and len(tasks) < self.attempts
+                done, pending = await asyncio.wait(
+                    pending, timeout=delay if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    tasks.append(
+                        asyncio.ensure_future(self.measure_async(arg))
+                    )
+                    pending.add(tasks[-1])
+                    continue
+                for task in done:
+                    if is_successful(task):
+                        self.count(tasks, task)
+                        return task.result()
+                    if failed is None:
+                        failed = task
+            self.count(tasks, failed)
+            return failed.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def __reduce__(self):
+        return Hedge, (
+            self.func, self.delay, self.percentile, self.attempts,
+            self.workers.size
+        )
+
+    def measure(self, arg):
+        start = time.perf_counter()
+        result = self.func(arg)
+        self.latency.record(time.perf_counter() - start)
+        return result
+
+    async def measure_async(self, arg):
+        start = time.perf_counter()
+        result = await call_async(self.func, arg)
+        self.latency.record(time.perf_counter() - start)
+        return result
+
+    def get_delay(self):
+        if self.delay is not None:
+            return self.delay
+        with self.latency.lock:
+            if self.latency.count < Hedge.MIN_SAMPLES:
+                return None
+            delay = self.latency.percentile(self.percentile)
+        return delay if math.isfinite(delay) else None
+
+    def count(self, attempts, winner):
+        with self.lock:
+            self.calls += 1
+            self.hedged += len(attempts) > 1
+            self.hedge_wins += winner is not attempts[0]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'delay_seconds': self.get_delay()
+            }
+
+
+class StageWorkers:
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('workers must be at least 1')
+        self.size = size
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def submit(self, func, arg, timeout=None):
+        if not self.slots.acquire(timeout=timeout):
+            return None
+        future = self.get_executor().submit(func, arg)
+        future.add_done_callback(self.release)
+        return future
+
+    def release(self, future):
+        self.slots.release()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    self.size
+                )
+            return self.executor
+
+
+def is_successful(future):
+    if future.exception() is not None:
+        return False
+    return future.result().__class__ is not Failure
+
+
+class FanOut:
+    def __init__(self, funcs, combine=tuple, fail_fast=True, workers=32):
+        if not funcs:
+            raise ValueError('at least one function is required')
+        self.funcs = funcs
+        self.combine = combine
+        self.fail_fast = fail_fast
+        self.workers = StageWorkers(workers)
+
+    def __call__(self, arg):
+        executor = self.workers.get_executor()
+        if not self.fail_fast:
+            futures = [
+                executor.submit(func, arg) for func in self.funcs[1:]
+            ]
+            try:
+                first = self.funcs[0](arg)
+            except Exception as exception:
+                first = Failure(exception)
+            return self.combine(
+                [first] + [get_outcome(future) for future in futures]
+            )
+        futures = [executor.submit(func, arg) for func in self.funcs]
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                if not is_successful(future):
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+        return self.combine([future.result() for future in futures])
+
+    async def run_async(self, arg):
+        tasks = [
+            asyncio.ensure_future(call_async(func, arg)) for func in self.funcs
+        ]
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not self.fail_fast:
+                    continue
+                for task in done:
+                    if not is_successful(task):
+                        return task.result()
+            return self.combine([get_outcome(task) for task in tasks])
+        finally:
+            for task in tasks:
+                if task in pending:
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+    def __reduce__(self):
+        return FanOut, (
+            self.funcs, self.combine, self.fail_fast, self.workers.size
+        )
+
+
+class BackgroundTee:
+    STOP = object()
+
+    def __init__(
+        self, func, queue_size=1024, block=False, workers=1, failure=None
+    ):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self.func = func
+        self.queue_size = queue_size
+        self.block = block
+        self.workers = workers
+        self.failure = failure
+        self.items = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.tasks = set()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def __call__(self, arg):
+        if not self.threads:
+            self.start()
+        try:
+            self.items.put(arg, block=self.block)
+        except queue.Full:
+            self.count('dropped')
+        else:
+            self.count('submitted')
+        return arg
+
+    async def run_async(self, arg):
+        while len(self.tasks) >= self.queue_size:
+            if not self.block:
+                self.count('dropped')
+                return arg
+            await asyncio.wait(
+                self.tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+        task = asyncio.ensure_future(self.apply_async(arg))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.count('submitted')
+        return arg
+
+    def __reduce__(self):
+        return BackgroundTee, (
+            self.func, self.queue_size, self.block, self.workers, self.failure
+        )
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            self.threads = [
+                threading.Thread(target=self.work, daemon=True)
+                for _ in range(self.workers)
+            ]
+            for thread in self.threads:
+                thread.start()
+        atexit.register(self.close)
+
+    def work(self):
+        while True:
+            arg = self.items.get()
+            try:
+                if arg is BackgroundTee.STOP:
+                    return
+                try:
+                    result = self.func(arg)
+                except Exception as exception:
+                    result = RaisedFailure(exception)
+                self.finish(arg, result)
+            finally:
+                self.items.task_done()
+
+    async def apply_async(self, arg):
+        try:
+            result = await call_async(self.func, arg)
+        except Exception as exception:
+            result = RaisedFailure(exception)
+        self.finish(arg, result)
+
+    def finish(self, arg, result):
+        if not is_failure(result):
+            self.count('completed')
+            return
+        self.count('failed')
+        if self.failure is None:
+            return
+        try:
+            call_failure(self.failure, arg, result)
+        except Exception:
+            pass
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.items.all_tasks_done:
+            while self.items.unfinished_tasks:
+                remaining = (
+                    None if deadline is None else deadline - time.monotonic()
+                )
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.items.all_tasks_done.wait(remaining)
+        return True
+
+    async def flush_async(self, timeout=None):
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=timeout)
+        return not self.tasks
+
+    def close(self, timeout=None):
+        is_flushed = self.flush(timeout)
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            try:
+                self.items.put(BackgroundTee.STOP, timeout=timeout)
+            except queue.Full:
+                break
+        for thread in threads:
+            thread.join(timeout)
+        atexit.unregister(self.close)
+        return is_flushed
+
+    def stats(self):
+        with self.lock:
+            return {
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'pending': self.items.unfinished_tasks + len(self.tasks)
+            }
+
+
+def tee_background(
+    *funcs, queue_size=1024, block=False, workers=1, failure=None
+):
+    return BackgroundTee(
+        compose(*funcs), queue_size, block, workers, failure
+    )
+
+
+def get_outcome(future):
+    try:
+        return future.result()
+    except Exception as exception:
+        return Failure(exception)
+
+
+def fan_out(*funcs, combine=tuple, fail_fast=True, workers=32):
+    return FanOut(funcs, combine, fail_fast, workers)
+
+
 class Track:
-    def __init__(self, func=identity):
+    def __init__(self, func=identity, metrics=None):
         self.func = func
+        self.metrics = metrics
 
     def __call__(self, arg):
         return self.func(arg)
 
-    def compose(self, *funcs):
-        return Track(compose(self.func, *funcs))
+    def measure(self, name, func):
+        if self.metrics is None or name is None:
+            return func
+        return MeasuredStage(self.metrics.stage(name), func)
 
-    def fold(self, success_func, handle_func):
-        return self.compose(success_func).handle(handle_func)
+    def compose(self, *funcs, name=None):
+        return type(self)(
+            compose(self.func, self.measure(name, compose(*funcs))),
+            self.metrics
+        )
+
+    def fold(self, success_func, handle_func, name=None):
+        return self.compose(
+            success_func, name=name
+        ).handle(
+            handle_func, name=name
+        )
+
+    def handle(self, *funcs, name=None):
+        return type(self)(
+            try_(self.func, handle=self.measure(name, compose(*funcs))),
+            self.metrics
+        )
 
-    def handle(self, *funcs):
-        return Track(try_(self.func, handle=compose(*funcs)))
+    def tee(self, *funcs, name=None):
+        return self.compose(tee(self.measure(name, compose(*funcs))))
+
+    def tee_background(
+        self, *funcs, queue_size=1024, block=False, workers=1, failure=None,
+        name=None
+    ):
+        return self.compose(BackgroundTee(
+            self.measure(name, compose(*funcs)),
+            queue_size, block, workers, failure
+        ))
+
+    def compile(self):
+        return type(self)(
+            compile_pipeline(Pipeline.from_funcs(self.func)), self.metrics
+        )
+
+    def cache(self, maxsize=128, ttl=None, key=None, cache_failures=False):
+        return type(self)(
+            Cache(self.func, maxsize, ttl, key, cache_failures), self.metrics
+        )
+
+    def map_stream(self, iterable, failure):
+        func = self.func
+        for value in iterable:
+            try:
+                result = func(value)
+            except Exception as exception:
+                failure(value, exception)
+                continue
+            if result.__class__ is Failure:
+                failure(value, result.exception)
+                continue
+            yield result
+
+    def coalesce(self, key=None):
+        return type(self)(Coalesce(self.func, key), self.metrics)
+
+    def batch(self, func, max_size=100, max_wait=0.005):
+        return self.compose(Batch(func, max_size, max_wait))
+
+    def pooled(self, pool, func):
+        return self.compose(Pooled(pool, func))
+
+    def fan_out(self, *funcs, combine=tuple, fail_fast=True, workers=32):
+        return self.compose(FanOut(funcs, combine, fail_fast, workers))
+
+    def timeout(self, seconds, workers=32):
+        return type(self)(Timeout(self.func, seconds, workers), self.metrics)
+
+    def hedge(self, delay=None, percentile=0.95, attempts=2, workers=32):
+        return type(self)(
+            Hedge(self.func, delay, percentile, attempts, workers),
+            self.metrics
+        )
 
-    def tee(self, *funcs):
-        return self.compose(tee(*funcs))
+    def segment(self, workers=1):
+        return self.compose(Segment(workers))
+
+    def map_threaded(self, iterable, failure, queue_size=16, ordered=True):
+        pipeline = ThreadedPipeline(Pipeline.from_funcs(self.func), queue_size)
+        pipeline.start(iterable)
+        try:
+            for value, result in pipeline.results(ordered):
+                if is_failure(result):
+                    call_failure(failure, value, result)
+                else:
+                    yield result
+        finally:
+            pipeline.close()
+
+    def map_partitioned(
+        self, iterable, failure, key, workers=4, queue_size=16, ordered=False
+    ):
+        pipeline = PartitionedPipeline(
+            Pipeline.from_funcs(self.func), key, workers, queue_size
+        )
+        pipeline.start(iterable)
+        try:
+            for value, result in pipeline.results(ordered):
+                if is_failure(result):
+                    call_failure(failure, value, result)
+                else:
+                    yield result
+        finally:
+            pipeline.close()
+
+    def map_batches(self, batches, failure, concatenate=concatenate_pieces):
+        pipeline = Pipeline.from_funcs(self.func)
+        for batch in batches:
+            pieces = []
+            for offset, result in BatchRun(pipeline, batch, concatenate).run():
+                if is_failure(result):
+                    call_failure(failure, batch[offset], result)
+                else:
+                    pieces.append(result)
+            yield concatenate(pieces) if pieces else batch[:0]
+
+    def map_parallel(
+        self, iterable, failure, workers=None, chunksize=1, ordered=True
+    ):
+        if chunksize < 1:
+            raise ValueError('chunksize must be at least 1')
+        workers = workers or os.cpu_count() or 1
+        values = iter(iterable)
+        chunks = iter(lambda: tuple(itertools.islice(values, chunksize)), ())
+        executor = concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=set_worker_func, initargs=(self.func,)
+        )
+        pending = {}
+        try:
+            while True:
+                capacity = 2 * workers - len(pending)
+                for chunk in itertools.islice(chunks, capacity):
+                    pending[executor.submit(run_chunk, chunk)] = chunk
+                if not pending:
+                    return
+                done = (next(iter(pending)),) if ordered else (
+                    concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    ).done
+                )
+                for future in done:
+                    chunk = pending.pop(future)
+                    for value, (is_success, result) in zip(
+                        chunk, future.result()
+                    ):
+                        if is_success:
+                            yield result
+                            continue
+                        try:
+                            raise result
+                        except Exception as exception:
+                            failure(value, exception)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+
+
+worker_func = identity
+
+
+def set_worker_func(func):
+    global worker_func
+    worker_func = func
+
+
+def run_chunk(chunk):
+    results = []
+    for value in chunk:
+        try:
+            result = worker_func(value)
+        except Exception as exception:
+            result = Failure(exception)
+        if result.__class__ is Failure:
+            results.append((False, to_portable_exception(result.exception)))
+        else:
+            results.append((True, result))
+    return results
+
+
+def to_portable_exception(exception):
+    try:
+        pickle.loads(pickle.dumps(exception))
+    except Exception:
+        return Exception(
+            '{0}: {1}'.format(type(exception).__name__, exception)
+        )
+    return exception
+
+
+class Segment:
+    def __init__(self, workers=1):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self.workers = workers
+
+    def __call__(self, arg):
+        return arg
+
+
+class ThreadedPipeline:
+    STOP = object()
+    POLL_SECONDS = 0.05
+
+    def __init__(self, pipeline, queue_size=16, segments=None):
+        if queue_size < 1:
+            raise ValueError('queue_size must be at least 1')
+        self.pipeline = pipeline
+        self.segments = (
+            get_segments(pipeline) if segments is None else segments
+        )
+        self.queues = [
+            queue.Queue(queue_size) for _ in range(len(self.segments) + 1)
+        ]
+        capacity = queue_size * len(self.queues)
+        self.slots = threading.Semaphore(
+            capacity + sum(workers for _, _, workers in self.segments)
+        )
+        self.closed = threading.Event()
+        self.lock = threading.Lock()
+        self.remaining = [workers for _, _, workers in self.segments]
+        self.threads = []
+        self.error = None
+
+    def start(self, iterable):
+        self.threads.append(threading.Thread(
+            target=self.produce, args=(iterable,), daemon=True
+        ))
+        for position, (_, stop, workers) in enumerate(self.segments):
+            self.threads.extend(
+                threading.Thread(
+                    target=self.work, args=(position, stop), daemon=True
+                )
+                for _ in range(workers)
+            )
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        self.closed.set()
+        for thread in self.threads:
+            thread.join()
+
+    def put(self, items, item):
+        while not self.closed.is_set():
+            try:
+                items.put(item, timeout=ThreadedPipeline.POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, items):
+        while not self.closed.is_set():
+            try:
+                return items.get(timeout=ThreadedPipeline.POLL_SECONDS)
+            except queue.Empty:
+                pass
+        return ThreadedPipeline.STOP
+
+    def produce(self, iterable):
+        outbox = self.queues[0]
+        try:
+            for sequence, value in enumerate(iterable):
+                while not self.slots.acquire(
+                    timeout=ThreadedPipeline.POLL_SECONDS
+                ):
+                    if self.closed.is_set():
+                        return
+                if not self.put(outbox, (sequence, value, (value, 0, []))):
+                    return
+        except Exception as exception:
+            self.error = exception
+        self.put(outbox, ThreadedPipeline.STOP)
+
+    def work(self, position, stop):
+        inbox, outbox = self.queues[position], self.queues[position + 1]
+        while True:
+            item = self.get(inbox)
+            if item is ThreadedPipeline.STOP:
+                break
+            sequence, value, state = item
+            if not self.put(outbox, (
+                sequence, value, self.pipeline.run_segment(*state, stop)
+            )):
+                return
+        self.put(inbox, ThreadedPipeline.STOP)
+        with self.lock:
+            self.remaining[position] -= 1
+            is_last = not self.remaining[position]
+        if is_last:
+            self.put(outbox, ThreadedPipeline.STOP)
+
+    def results(self, ordered=True):
+        outbox = self.queues[-1]
+        buffer = {}
+        expected = 0
+        while True:
+            item = self.get(outbox)
+            if item is ThreadedPipeline.STOP:
+                break
+            sequence, value, (result, _, _) = item
+            if not ordered:
+                self.slots.release()
+                yield value, result
+                continue
+            buffer[sequence] = (value, result)
+            while expected in buffer:
+                value, result = buffer.pop(expected)
+                expected += 1
+                self.slots.release()
+                yield value, result
+        if self.error is not None:
+            raise self.error
+
+
+class PartitionedPipeline(ThreadedPipeline):
+    def __init__(self, pipeline, key, workers=4, queue_size=16):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        super().__init__(
+            pipeline, queue_size, [(0, len(pipeline.stages), 1)] * workers
+        )
+        self.key = key
+
+    def produce(self, iterable):
+        inboxes, outbox = self.queues[:-1], self.queues[-1]
+        try:
+            for sequence, value in enumerate(iterable):
+                while not self.slots.acquire(
+                    timeout=ThreadedPipeline.POLL_SECONDS
+                ):
+                    if self.closed.is_set():
+                        return
+                try:
+                    inbox = inboxes[hash(self.key(value)) % len(inboxes)]
+                except Exception as exception:
+                    item = (sequence, value, (RaisedFailure(exception), 0, []))
+                    if not self.put(outbox, item):
+                        return
+                    continue
+                if not self.put(inbox, (sequence, value)):
+                    return
+        except Exception as exception:
+            self.error = exception
+        for inbox in inboxes:
+            self.put(inbox, ThreadedPipeline.STOP)
+
+    def work(self, position, stop):
+        inbox, outbox = self.queues[position], self.queues[-1]
+        while True:
+            item = self.get(inbox)
+            if item is ThreadedPipeline.STOP:
+                break
+            sequence, value = item
+            if not self.put(outbox, (
+                sequence, value, self.pipeline.run_segment(value, 0, [], stop)
+            )):
+                return
+        with self.lock:
+            self.remaining[position] -= 1
+            is_last = not any(self.remaining)
+        if is_last:
+            self.put(outbox, ThreadedPipeline.STOP)
+
+
+def get_segments(pipeline):
+    stages = pipeline.stages
+    bounds = [
+        index for index, (kind, func, _) in enumerate(stages)
+        if kind == Pipeline.CALL and isinstance(func, Segment)
+    ]
+    starts = [0] + bounds
+    stops = bounds + [len(stages)]
+    workers = [stages[index][1].workers for index in bounds] + [1]
+    if bounds and bounds[-1] == len(stages) - 1:
+        stops[-2:] = [len(stages)]
+        starts.pop()
+        workers.pop()
+    return list(zip(starts, stops, workers))
+
+
+def get_unsupported_error(name):
+    return TypeError(
+        'AsyncTrack does not support {0}, use map_stream with a '
+        'concurrency instead'.format(name)
+    )
+
+
+class AsyncTrack(Track):
+    def __init__(self, func=identity, metrics=None):
+        super().__init__(func, metrics)
+        self.pipeline = Pipeline.from_funcs(func)
+
+    async def __call__(self, arg):
+        return await self.pipeline.run_async(arg)
+
+    def compile(self):
+        return type(self)(
+            compile_pipeline(self.pipeline, is_async=True), self.metrics
+        )
+
+    def map_threaded(self, iterable, failure, queue_size=16, ordered=True):
+        raise get_unsupported_error('map_threaded')
+
+    def map_batches(self, batches, failure, concatenate=concatenate_pieces):
+        raise get_unsupported_error('map_batches')
+
+    def map_partitioned(
+        self, iterable, failure, key, workers=4, queue_size=16, ordered=False
+    ):
+        raise get_unsupported_error('map_partitioned')
+
+    def map_parallel(
+        self, iterable, failure, workers=None, chunksize=1, ordered=True
+    ):
+        raise get_unsupported_error('map_parallel')
+
+    async def map_stream(self, iterable, failure, concurrency=1):
+        values = iterate_async(iterable).__aiter__()
+        pending = collections.deque()
+        try:
+            while True:
+                async for value in values:
+                    pending.append((value, asyncio.ensure_future(self(value))))
+                    if len(pending) >= concurrency:
+                        break
+                if not pending:
+                    return
+                value, task = pending.popleft()
+                try:
+                    result = await task
+                except Exception as exception:
+                    result = failure(value, exception)
+                    if inspect.isawaitable(result):
+                        await result
+                    continue
+                if result.__class__ is Failure:
+                    result = failure(value, result.exception)
+                    if inspect.isawaitable(result):
+                        await result
+                    continue
+                yield result
+        finally:
+            for _, task in pending:
+                task.cancel()
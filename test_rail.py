@@ -1,7 +1,18 @@
+import asyncio
+import gc
+import inspect
+import itertools
+import operator
+import os
+import pickle
 import sys
+import tempfile
+import threading
+import time
 import traceback
 import unittest
 import unittest.mock
+import weakref
 
 import rail
 
@@ -84,6 +95,108 @@ class TestTry(unittest.TestCase):
         handle.assert_called_once_with(exception)
 
 
+class TestFailure(unittest.TestCase):
+    def test_failure_skips_later_stages(self):
+        exception = ValueError('value')
+        func = unittest.mock.Mock()
+        track = rail.Track().compose(
+            lambda _: rail.Failure(exception),
+            func
+        ).handle(
+            lambda exception: exception
+        )
+        self.assertEqual(exception, track(unittest.mock.Mock()))
+        func.assert_not_called()
+
+    def test_unhandled_failure_returned(self):
+        exception = ValueError('value')
+        func = unittest.mock.Mock()
+        result = rail.compose(lambda _: rail.Failure(exception), func)(1)
+        self.assertIsInstance(result, rail.Failure)
+        self.assertEqual(exception, result.exception)
+        func.assert_not_called()
+
+    def test_failure_does_not_capture_traceback(self):
+        failures = []
+        track = rail.Track().compose(
+            lambda _: rail.Failure(ValueError('value'))
+        ).handle(
+            lambda exception: failures.append(exception)
+        )
+        track(unittest.mock.Mock())
+        self.assertIsNone(failures[0].__traceback__)
+
+    def test_failure_returned_by_handle_routed_to_outer_handle(self):
+        exception = ValueError('value')
+        inner_handle = unittest.mock.Mock(
+            side_effect=lambda exception: rail.Failure(exception)
+        )
+        track = rail.Track().compose(
+            lambda _: rail.raise_(exception)
+        ).handle(
+            inner_handle
+        ).compose(
+            unittest.mock.Mock()
+        ).handle(
+            lambda exception: str(exception)
+        )
+        self.assertEqual('value', track(unittest.mock.Mock()))
+        inner_handle.assert_called_once_with(exception)
+
+    def test_exception_raised_by_handle_of_failure(self):
+        track = rail.Track().compose(
+            lambda _: rail.Failure(ValueError('value'))
+        ).handle(
+            rail.raise_
+        )
+        with self.assertRaises(ValueError):
+            track(unittest.mock.Mock())
+
+    def test_fold_with_failure(self):
+        track = rail.Track().compose(
+            lambda value: value if value > 0 else rail.Failure(
+                ValueError('value')
+            )
+        ).fold(
+            lambda value: value * 2,
+            lambda exception: str(exception)
+        )
+        self.assertEqual(4, track(2))
+        self.assertEqual('value', track(-2))
+
+    def test_failure_within_tee_skips_rest_of_tee(self):
+        func = unittest.mock.Mock()
+        track = rail.Track().tee(
+            lambda _: rail.Failure(ValueError('value')),
+            func
+        ).handle(
+            lambda exception: 'handled'
+        )
+        self.assertEqual('handled', track(unittest.mock.Mock()))
+        func.assert_not_called()
+
+    def test_map_stream_passes_failures_to_failure_func(self):
+        exception = ValueError('value')
+        failures = []
+        results = rail.Track().compose(
+            lambda value: value if value > 0 else rail.Failure(exception)
+        ).map_stream(
+            [1, -2, 3],
+            lambda value, exception: failures.append((value, exception))
+        )
+        self.assertEqual([1, 3], list(results))
+        self.assertEqual([(-2, exception)], failures)
+
+    def test_failures_not_cached_by_default(self):
+        func = unittest.mock.Mock(
+            return_value=rail.Failure(ValueError('value'))
+        )
+        track = rail.Track().compose(func).cache()
+        track(1)
+        track(1)
+        self.assertEqual(2, func.call_count)
+
+
 class TestMatch(unittest.TestCase):
     def test_no_match_statements_provided(self):
         value = unittest.mock.Mock()
@@ -120,6 +233,116 @@ class TestMatch(unittest.TestCase):
         )
         self.assertEqual(expected_value, match(unittest.mock.Mock()))
 
+    def test_equality_arms_use_first_match(self):
+        match = rail.match(
+            (rail.eq(1), lambda _: 'one'),
+            (rail.eq('a'), lambda _: 'a'),
+            (rail.eq(True), lambda _: 'true'),
+            (rail.eq(None), lambda _: 'none')
+        )
+        self.assertEqual('one', match(1))
+        self.assertEqual('one', match(True))
+        self.assertEqual('one', match(1.0))
+        self.assertEqual('a', match('a'))
+        self.assertEqual('none', match(None))
+        with self.assertRaises(rail.UnmatchedValueError):
+            match(2)
+
+    def test_equality_arms_with_unhashable_value(self):
+        match = rail.match(
+            (rail.eq(1), lambda _: 'one'),
+            (rail.eq(2), lambda _: 'two')
+        )
+        value = unittest.mock.MagicMock()
+        value.__eq__.return_value = True
+        self.assertEqual('one', match(value))
+
+    def test_range_arms_use_first_match(self):
+        match = rail.match(
+            (rail.lt(0), lambda _: 'negative'),
+            (rail.eq(0), lambda _: 'zero'),
+            (rail.le(10), lambda _: 'small'),
+            (rail.gt(100), lambda _: 'large'),
+            (rail.ge(5), lambda _: 'medium')
+        )
+        self.assertEqual('negative', match(-0.5))
+        self.assertEqual('zero', match(0))
+        self.assertEqual('small', match(0.5))
+        self.assertEqual('small', match(10))
+        self.assertEqual('medium', match(10.5))
+        self.assertEqual('large', match(100.5))
+        with self.assertRaises(rail.UnmatchedValueError):
+            match(float('nan'))
+
+    def test_compiled_arms_with_uncompiled_arm_between(self):
+        is_match = unittest.mock.Mock(return_value=True)
+        match = rail.match(
+            (rail.lt(0), lambda _: 'negative'),
+            (rail.lt(10), lambda _: 'small'),
+            (is_match, lambda _: 'other'),
+            (rail.lt(100), lambda _: 'medium')
+        )
+        self.assertEqual('small', match(5))
+        is_match.assert_not_called()
+        self.assertEqual('other', match(50))
+        is_match.assert_called_once_with(50)
+
+    def test_exclusive_arms_reordered_by_hits(self):
+        is_a = unittest.mock.Mock(side_effect=lambda value: value == 'a')
+        is_b = unittest.mock.Mock(side_effect=lambda value: value == 'b')
+        match = rail.match(
+            (is_a, lambda _: 'first'),
+            (is_b, lambda _: 'second'),
+            exclusive=True
+        )
+        with unittest.mock.patch.object(
+            rail.AdaptiveMatch, 'REORDER_INTERVAL', 3
+        ):
+            for value in 'abb':
+                match(value)
+            self.assertEqual(
+                ((is_b, match.args[1][1]), (is_a, match.args[0][1])),
+                match.order()
+            )
+            is_a.reset_mock()
+            self.assertEqual('second', match('b'))
+            is_a.assert_not_called()
+            self.assertEqual('first', match('a'))
+
+    def test_exclusive_order_keeps_tables_together(self):
+        is_other = unittest.mock.Mock(side_effect=lambda value: value == 'x')
+        map_funcs = [unittest.mock.Mock() for _ in range(3)]
+        match = rail.match(
+            (rail.eq(1), map_funcs[0]),
+            (rail.eq(2), map_funcs[1]),
+            (is_other, map_funcs[2]),
+            exclusive=True
+        )
+        with unittest.mock.patch.object(
+            rail.AdaptiveMatch, 'REORDER_INTERVAL', 2
+        ):
+            match('x')
+            match('x')
+        self.assertEqual(
+            ((is_other, map_funcs[2]), match.args[0], match.args[1]),
+            match.order()
+        )
+
+    def test_exclusive_value_unmatched(self):
+        match = rail.match((rail.eq(1), rail.identity), exclusive=True)
+        with self.assertRaises(rail.UnmatchedValueError):
+            match(2)
+
+    def test_not_reordered_by_default(self):
+        is_match = unittest.mock.Mock(return_value=True)
+        match = rail.match(
+            (lambda _: True, lambda _: 'first'),
+            (is_match, lambda _: 'second')
+        )
+        for _ in range(rail.AdaptiveMatch.REORDER_INTERVAL + 1):
+            self.assertEqual('first', match(unittest.mock.Mock()))
+        is_match.assert_not_called()
+
 
 class TestMatchType(unittest.TestCase):
     def test_no_match_statements_provided(self):
@@ -166,6 +389,47 @@ class TestMatchType(unittest.TestCase):
         )
         self.assertEqual(expected_value, match(unittest.mock.Mock()))
 
+    def test_value_unmatched_on_repeated_calls(self):
+        match = rail.match_type((str, lambda _: unittest.mock.Mock()))
+        for value in (1, 2):
+            with self.assertRaises(rail.UnmatchedValueError) as context:
+                match(value)
+            self.assertEqual(value, context.exception.value)
+
+    def test_match_cached_per_type(self):
+        class Base:
+            pass
+
+        class Derived(Base):
+            pass
+        base_func = unittest.mock.Mock()
+        derived_func = unittest.mock.Mock()
+        match = rail.match_type(
+            (Derived, derived_func),
+            (Base, base_func)
+        )
+        base = Base()
+        derived = Derived()
+        match(derived)
+        match(base)
+        match(derived)
+        self.assertEqual(
+            [unittest.mock.call(derived), unittest.mock.call(derived)],
+            derived_func.call_args_list
+        )
+        base_func.assert_called_once_with(base)
+        self.assertEqual({Derived, Base}, set(match.cache))
+
+    def test_value_with_overridden_class_not_cached(self):
+        expected_value = unittest.mock.Mock()
+        match = rail.match_type(
+            (KeyError, lambda _: expected_value),
+            (unittest.mock.Mock, lambda _: unittest.mock.Mock())
+        )
+        value = unittest.mock.Mock(spec=KeyError)
+        self.assertEqual(expected_value, match(value))
+        self.assertNotEqual(expected_value, match(unittest.mock.Mock()))
+
 
 class TestMatchLength(unittest.TestCase):
     def test_no_match_statements_provided(self):
@@ -340,6 +604,45 @@ class TestPartial(unittest.TestCase):
             {'arg1': val1, 'arg2': val2}, func(arg1=val1, arg2=val2)
         )
 
+    def test_func_with_keyword_only_arguments(self):
+        @rail.partial
+        def func(arg1, *, arg2, arg3='val3'):
+            return arg1, arg2, arg3
+        val1 = unittest.mock.Mock()
+        val2 = unittest.mock.Mock()
+        val3 = unittest.mock.Mock()
+        self.assertEqual((val1, val2, 'val3'), func(val1)(arg2=val2))
+        self.assertEqual((val1, val2, 'val3'), func(arg2=val2)(val1))
+        self.assertEqual(
+            (val1, val2, val3), func(val1, arg3=val3)(arg2=val2)
+        )
+        self.assertEqual((val1, val2, val3), func(val1, arg2=val2, arg3=val3))
+
+    def test_partially_applied_func_reused(self):
+        @rail.partial
+        def func(arg1, arg2, arg3):
+            return arg1, arg2, arg3
+        val1 = unittest.mock.Mock()
+        val2 = unittest.mock.Mock()
+        val3 = unittest.mock.Mock()
+        val4 = unittest.mock.Mock()
+        partial_func = func(val1)
+        self.assertEqual((val1, val2, val3), partial_func(val2, val3))
+        self.assertEqual((val1, val3, val4), partial_func(val3)(val4))
+        self.assertEqual((val1, val4, val2), partial_func(val4, val2))
+
+    def test_signature_inspected_once(self):
+        def func(arg1, arg2, arg3):
+            return arg1, arg2, arg3
+        with unittest.mock.patch(
+            'inspect.signature', wraps=rail.inspect.signature
+        ) as signature:
+            partial_func = rail.partial(func)
+            partial_func(1)(2)(3)
+            partial_func(1, 2)(3)
+            partial_func(1, 2, 3)
+        signature.assert_called_once_with(func, follow_wrapped=False)
+
     def test_docstring_preserved(self):
         @rail.partial
         def func1(arg1, arg2):
@@ -389,6 +692,21 @@ class TestCompose(unittest.TestCase):
         func2.assert_called_once_with(return_value1)
         func3.assert_called_once_with(return_value2)
 
+    def test_compose_with_deeply_nested_compositions(self):
+        func = rail.compose()
+        for _ in range(5000):
+            func = rail.compose(func, lambda value: value + 1)
+        self.assertEqual(5000, func(0))
+
+    def test_compose_flattens_nested_compositions(self):
+        func1 = unittest.mock.Mock()
+        func2 = unittest.mock.Mock()
+        func3 = unittest.mock.Mock()
+        func = rail.compose(rail.compose(func1, func2), rail.Track(), func3)
+        self.assertEqual(
+            [func1, func2, func3], [func for _, func, _ in func.stages]
+        )
+
 
 class TestPipe(unittest.TestCase):
     def test_pipe(self):
@@ -404,6 +722,12 @@ class TestPipe(unittest.TestCase):
             )
         )
 
+    def test_failure_skips_remaining_funcs(self):
+        failure = rail.Failure(ValueError())
+        func = unittest.mock.Mock()
+        self.assertIs(failure, rail.pipe(1, lambda _: failure, func))
+        func.assert_not_called()
+
     def test_use_pipe_to_create_scope(self):
         val1 = unittest.mock.Mock()
         val2 = unittest.mock.Mock()
@@ -436,6 +760,112 @@ class TestTee(unittest.TestCase):
         func3.assert_called_once_with(func2.return_value)
 
 
+class TestTeeBackground(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def test_returns_value_without_waiting(self):
+        calls = []
+
+        def sink(value):
+            self.release.wait(5)
+            calls.append(value)
+        tee = rail.tee_background(sink)
+        self.addCleanup(tee.close)
+        func = rail.Track().compose(tee).compose(lambda value: value * 2)
+        self.assertEqual(4, func(2))
+        self.assertEqual([], calls)
+        self.release.set()
+        self.assertTrue(tee.flush(5))
+        self.assertEqual([2], calls)
+
+    def test_drops_when_full(self):
+        tee = rail.tee_background(
+            lambda value: self.release.wait(5), queue_size=1
+        )
+        self.addCleanup(tee.close)
+        for value in range(5):
+            self.assertEqual(value, tee(value))
+        self.release.set()
+        tee.flush(5)
+        stats = tee.stats()
+        self.assertGreaterEqual(stats['dropped'], 3)
+        self.assertEqual(5, stats['submitted'] + stats['dropped'])
+        self.assertEqual(stats['submitted'], stats['completed'])
+
+    def test_blocks_when_full(self):
+        tee = rail.tee_background(
+            lambda value: time.sleep(0.001), queue_size=1, block=True
+        )
+        self.addCleanup(tee.close)
+        for value in range(5):
+            tee(value)
+        tee.flush(5)
+        self.assertEqual(
+            {
+                'submitted': 5, 'completed': 5, 'failed': 0, 'dropped': 0,
+                'pending': 0
+            },
+            tee.stats()
+        )
+
+    def test_failures_counted_and_reported(self):
+        failure = unittest.mock.Mock()
+        tee = rail.tee_background(
+            lambda value: rail.raise_(KeyError(value)), failure=failure
+        )
+        self.addCleanup(tee.close)
+        tee(1)
+        tee.flush(5)
+        self.assertEqual(1, tee.stats()['failed'])
+        value, exception = failure.call_args[0]
+        self.assertEqual(1, value)
+        self.assertIsInstance(exception, KeyError)
+
+    def test_close_flushes_and_stops_workers(self):
+        calls = []
+        thread_count = threading.active_count()
+        tee = rail.tee_background(calls.append, workers=2)
+        for value in range(10):
+            tee(value)
+        self.assertTrue(tee.close(5))
+        self.assertCountEqual(range(10), calls)
+        self.assertEqual(thread_count, threading.active_count())
+
+    def test_track_method(self):
+        calls = []
+        func = rail.Track().tee_background(
+            lambda value: value * 2, calls.append
+        )
+        tee = func.func
+        self.addCleanup(tee.close)
+        self.assertEqual(3, func(3))
+        tee.flush(5)
+        self.assertEqual([6], calls)
+
+    def test_async(self):
+        calls = []
+
+        async def sink(value):
+            await asyncio.sleep(0.01)
+            calls.append(value)
+
+        async def run():
+            results = [await func(value) for value in range(3)]
+            self.assertEqual([], calls)
+            await func.func.flush_async()
+            return results
+        func = rail.AsyncTrack().tee_background(sink, queue_size=2)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual([0, 1, 2], loop.run_until_complete(run()))
+        finally:
+            loop.close()
+        self.assertEqual([0, 1], calls)
+        self.assertEqual(1, func.func.stats()['dropped'])
+
+
 class TestCallWith(unittest.TestCase):
     def test_calls_function_with_value(self):
         value = unittest.mock.Mock()
@@ -456,10 +886,210 @@ class TestCallWith(unittest.TestCase):
         )
 
 
+class TestMap(unittest.TestCase):
+    def test_maps_values_lazily(self):
+        func = unittest.mock.Mock(side_effect=lambda value: value * 2)
+        results = rail.map_(func)(itertools.count())
+        func.assert_not_called()
+        self.assertEqual([0, 2, 4], list(itertools.islice(results, 3)))
+        self.assertEqual(3, func.call_count)
+
+
+class TestFilter(unittest.TestCase):
+    def test_filters_with_comparison(self):
+        self.assertEqual(
+            [1, 3], list(rail.filter_(rail.gt(0))([1, -2, 3, 0]))
+        )
+
+    def test_filters_lazily(self):
+        results = rail.filter_(rail.gt(10))(itertools.count())
+        self.assertEqual(11, next(results))
+
+
+class TestFlatMap(unittest.TestCase):
+    def test_flattens_results(self):
+        self.assertEqual(
+            [1, 1, 2, 2],
+            list(rail.flat_map(lambda value: [value] * 2)([1, 2]))
+        )
+
+    def test_flattens_lazily(self):
+        results = rail.flat_map(range)(itertools.count())
+        self.assertEqual([0, 0, 1], list(itertools.islice(results, 3)))
+
+
+class TestChunk(unittest.TestCase):
+    def test_last_chunk_may_be_short(self):
+        self.assertEqual(
+            [(0, 1), (2, 3), (4,)], list(rail.chunk(2)(range(5)))
+        )
+
+    def test_chunks_lazily(self):
+        results = rail.chunk(3)(itertools.count())
+        self.assertEqual((0, 1, 2), next(results))
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            rail.chunk(0, [])
+
+
+class TestWindow(unittest.TestCase):
+    def test_sliding_windows(self):
+        self.assertEqual(
+            [(0, 1, 2), (1, 2, 3)], list(rail.window(3)(range(4)))
+        )
+
+    def test_fewer_values_than_size(self):
+        self.assertEqual([], list(rail.window(3)(range(2))))
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            rail.window(0, [])
+
+
+class TestScan(unittest.TestCase):
+    def test_running_fold(self):
+        self.assertEqual(
+            [1, 3, 6], list(rail.scan(operator.add, 0)([1, 2, 3]))
+        )
+
+    def test_streams_compose_into_track(self):
+        func = rail.Track().compose(
+            rail.filter_(rail.gt(0)),
+            rail.map_(lambda value: value * 2),
+            rail.chunk(2),
+            rail.scan(lambda total, values: total + sum(values), 0)
+        )
+        results = func(itertools.count(-5))
+        self.assertEqual([6, 20, 42], list(itertools.islice(results, 3)))
+
+
+class TestReadRecords(unittest.TestCase):
+    def write_file(self, data):
+        file = tempfile.NamedTemporaryFile(delete=False)
+        self.addCleanup(os.unlink, file.name)
+        with file:
+            file.write(data)
+        return file.name
+
+    def test_delimited_records(self):
+        path = self.write_file(b'one\ntwo\n\nthree')
+        records = list(rail.read_records(path))
+        self.assertTrue(all(
+            isinstance(record, memoryview) for record in records
+        ))
+        self.assertEqual(
+            [b'one', b'two', b'', b'three'], list(map(bytes, records))
+        )
+
+    def test_trailing_delimiter(self):
+        path = self.write_file(b'one||two||')
+        self.assertEqual(
+            [b'one', b'two'],
+            list(map(bytes, rail.read_records(path, delimiter=b'||')))
+        )
+
+    def test_fixed_width_records(self):
+        path = self.write_file(b'aaabbbcc')
+        self.assertEqual(
+            [b'aaa', b'bbb', b'cc'],
+            list(map(bytes, rail.read_records(path, width=3)))
+        )
+
+    def test_byte_range(self):
+        path = self.write_file(b'one\ntwo\nthree\n')
+        self.assertEqual(
+            [b'two'],
+            list(map(bytes, rail.read_records(path, start=4, stop=8)))
+        )
+
+    def test_empty_file(self):
+        self.assertEqual([], list(rail.read_records(self.write_file(b''))))
+
+    def test_records_usable_after_exhausted(self):
+        path = self.write_file(b'one\ntwo')
+        records = list(rail.read_records(path))
+        self.assertEqual('two', str(records[1], 'utf-8'))
+
+    def test_invalid_format(self):
+        with self.assertRaises(ValueError):
+            rail.read_records('path', delimiter=b'')
+        with self.assertRaises(ValueError):
+            rail.read_records('path', width=0)
+
+    def test_split_file_aligned_to_records(self):
+        data = b'one\ntwo\nthree\nfour\nfive\n'
+        path = self.write_file(data)
+        ranges = rail.split_file(path, 3)
+        self.assertEqual(3, len(ranges))
+        self.assertEqual(0, ranges[0][0])
+        self.assertEqual(len(data), ranges[-1][1])
+        self.assertEqual(
+            [b'one', b'two', b'three', b'four', b'five'],
+            [
+                bytes(record) for start, stop in ranges
+                for record in rail.read_records(path, start=start, stop=stop)
+            ]
+        )
+
+    def test_split_file_self_overlapping_delimiter(self):
+        path = self.write_file(b'a\n\n\n\nb\n\nc')
+        delimiter = b'\n\n'
+        self.assertEqual(
+            [b'a', b'', b'b', b'c'],
+            [
+                bytes(record)
+                for start, stop in rail.split_file(path, 2, delimiter)
+                for record in rail.read_records(
+                    path, delimiter, start=start, stop=stop
+                )
+            ]
+        )
+
+    def test_split_file_fixed_width(self):
+        path = self.write_file(b'aaabbbcccddd')
+        self.assertEqual(
+            [(0, 6), (6, 12)], rail.split_file(path, 2, width=3)
+        )
+
+    def test_split_file_more_parts_than_records(self):
+        path = self.write_file(b'one\ntwo\n')
+        self.assertEqual([(0, 4), (4, 8)], rail.split_file(path, 5))
+
+    def test_split_file_empty(self):
+        self.assertEqual([], rail.split_file(self.write_file(b''), 4))
+
+
 class TestLt(unittest.TestCase):
     def test_pipe_returns_true(self):
         self.assertTrue(rail.pipe(5, rail.lt(7)))
 
+    def test_exposes_operator_and_operand(self):
+        comparison = rail.lt(7)
+        self.assertEqual(operator.lt, comparison.operator)
+        self.assertEqual(7, comparison.operand)
+
+    def test_called_with_both_values(self):
+        self.assertTrue(rail.lt(9, 0))
+        self.assertFalse(rail.lt(7, 13))
+
+    def test_called_with_keywords(self):
+        self.assertTrue(rail.lt(value1=1, value2=2))
+        self.assertFalse(rail.lt(value1=3)(2))
+        self.assertEqual(2, rail.lt(value2=2).operand)
+
+    def test_called_without_values(self):
+        self.assertTrue(rail.lt()(2)(1))
+
+    def test_comparison_called_with_keyword(self):
+        self.assertTrue(rail.lt(2)(value1=1))
+
+    def test_name(self):
+        self.assertEqual('lt', rail.lt.__name__)
+        self.assertEqual(
+            ['value2', 'value1'], list(inspect.signature(rail.lt).parameters)
+        )
+
     def test_pipe_returns_false(self):
         self.assertFalse(rail.pipe(8, rail.lt(1)))
 
@@ -652,6 +1282,1630 @@ class TestTrack(unittest.TestCase):
         actual_tb = traceback.format_tb(actual_exc_info[2])
         self.assertEqual(expected_tb, actual_tb[-len(expected_tb):])
 
+    def test_compose_with_many_stages(self):
+        func = rail.Track()
+        for _ in range(5000):
+            func = func.compose(
+                lambda value: value + 1
+            ).handle(
+                lambda exception: self.fail()
+            ).tee(
+                lambda value: value
+            )
+        self.assertEqual(5000, func(0))
+
+    def test_handle_with_many_handlers(self):
+        func = rail.Track().compose(
+            lambda _: rail.raise_(ValueError('value'))
+        )
+        for _ in range(5000):
+            func = func.handle(rail.raise_)
+        func = func.handle(lambda exception: str(exception))
+        self.assertEqual('value', func(unittest.mock.Mock()))
+
+    def test_handle_within_tee_does_not_catch_later_exceptions(self):
+        expected_value = unittest.mock.Mock()
+        func = rail.Track().tee(
+            rail.Track().compose(
+                lambda _: rail.raise_(KeyError('key'))
+            ).handle(
+                lambda exception: unittest.mock.Mock()
+            )
+        ).compose(
+            lambda _: rail.raise_(ValueError('value'))
+        ).handle(
+            lambda exception: expected_value
+        )
+        self.assertEqual(expected_value, func(unittest.mock.Mock()))
+
+    def test_map_stream_yields_results_lazily(self):
+        func = unittest.mock.Mock(side_effect=lambda value: value * 2)
+        failure = unittest.mock.Mock()
+        results = rail.Track().compose(func).map_stream([1, 2, 3], failure)
+        func.assert_not_called()
+        self.assertEqual(2, next(results))
+        func.assert_called_once_with(1)
+        self.assertEqual([4, 6], list(results))
+        failure.assert_not_called()
+
+    def test_map_stream_passes_failures_to_failure_func(self):
+        exception = ValueError('value')
+        failures = []
+        results = rail.Track().compose(
+            lambda value: value if value > 0 else rail.raise_(exception)
+        ).map_stream(
+            [1, -2, 3, -4],
+            lambda value, exception: failures.append((value, exception))
+        )
+        self.assertEqual([1, 3], list(results))
+        self.assertEqual([(-2, exception), (-4, exception)], failures)
+
+    def test_map_stream_stops_when_failure_func_raises(self):
+        results = rail.Track().compose(
+            lambda value: value if value > 0 else rail.raise_(KeyError('key'))
+        ).map_stream(
+            [1, -2, 3],
+            lambda value, exception: rail.raise_()
+        )
+        self.assertEqual(1, next(results))
+        with self.assertRaises(KeyError):
+            next(results)
+
+    def test_pickle_round_trip(self):
+        func = rail.Track().compose(
+            int,
+            rail.match(
+                (rail.lt(0), rail.identity),
+                (rail.ge(0), str)
+            )
+        ).tee(
+            rail.match_type((str, len))
+        ).handle(
+            rail.raise_
+        ).compose(
+            rail.match_length((rail.eq(1), rail.identity))
+        )
+        unpickled_func = pickle.loads(pickle.dumps(func))
+        self.assertEqual('7', unpickled_func('7'))
+        with self.assertRaises(ValueError):
+            unpickled_func('x')
+
+    def test_pickle_round_trip_with_partial_of_module_func(self):
+        func = rail.Track().compose(rail.partial(operator.add)(1))
+        self.assertEqual(3, pickle.loads(pickle.dumps(func))(2))
+
+    def test_map_parallel_invalid_chunksize(self):
+        results = rail.Track().map_parallel(
+            [1], lambda value, exception: self.fail(), chunksize=0
+        )
+        with self.assertRaises(ValueError):
+            list(results)
+
+    def test_map_parallel_preserves_order(self):
+        failures = []
+        results = rail.Track().compose(int).map_parallel(
+            ['1', '2', 'x', '4', '5', 'y', '7'],
+            lambda value, exception: failures.append(value),
+            workers=2,
+            chunksize=2
+        )
+        self.assertEqual([1, 2, 4, 5, 7], list(results))
+        self.assertEqual(['x', 'y'], failures)
+
+    def test_map_parallel_unordered(self):
+        results = rail.Track().compose(abs).map_parallel(
+            range(-50, 50),
+            lambda value, exception: self.fail(),
+            workers=3,
+            chunksize=7,
+            ordered=False
+        )
+        self.assertEqual(
+            sorted(abs(value) for value in range(-50, 50)), sorted(results)
+        )
+
+    def test_map_parallel_failure_passed_as_exception(self):
+        failures = []
+        results = rail.Track().compose(int).map_parallel(
+            ['x'],
+            lambda value, exception: failures.append(exception),
+            workers=1
+        )
+        self.assertEqual([], list(results))
+        self.assertIsInstance(failures[0], ValueError)
+
+    def test_segment_passes_value_through(self):
+        func = rail.Track().compose(abs).segment(workers=2).compose(str)
+        self.assertEqual('5', func(-5))
+
+    def test_map_threaded_preserves_order(self):
+        failures = []
+        results = rail.Track().compose(int).segment(workers=3).compose(
+            lambda value: value * 2
+        ).map_threaded(
+            ['1', '2', 'x', '4', '5', 'y', '7'],
+            lambda value, exception: failures.append(value),
+            queue_size=2
+        )
+        self.assertEqual([2, 4, 8, 10, 14], list(results))
+        self.assertEqual(['x', 'y'], failures)
+
+    def test_map_threaded_segments_overlap(self):
+        second_value_started = threading.Event()
+        overlapped = []
+
+        def first(value):
+            if value == 1:
+                second_value_started.set()
+            return value
+
+        def second(value):
+            if value == 0:
+                overlapped.append(second_value_started.wait(5))
+            return value
+        results = rail.Track().compose(first).segment().compose(
+            second
+        ).map_threaded(range(3), lambda value, exception: self.fail())
+        self.assertEqual([0, 1, 2], list(results))
+        self.assertEqual([True], overlapped)
+
+    def test_map_threaded_handle_in_later_segment(self):
+        failures = []
+        results = rail.Track().compose(
+            lambda value: value if value > 0 else rail.raise_(
+                ValueError('value')
+            )
+        ).segment(workers=2).compose(
+            lambda value: value * 2
+        ).handle(
+            lambda exception: rail.raise_()
+        ).map_threaded(
+            [1, -2, 3],
+            lambda value, exception: failures.append((value, exception))
+        )
+        self.assertEqual([2, 6], list(results))
+        self.assertEqual(-2, failures[0][0])
+        self.assertIsInstance(failures[0][1], ValueError)
+
+    def test_map_threaded_applies_backpressure(self):
+        values_read = []
+
+        def read():
+            for value in itertools.count():
+                values_read.append(value)
+                yield value
+        results = rail.Track().segment().map_threaded(
+            read(), lambda value, exception: self.fail(), queue_size=1
+        )
+        self.assertEqual(0, next(results))
+        time.sleep(0.1)
+        self.assertLess(len(values_read), 10)
+        results.close()
+
+    def test_segment_invalid_workers(self):
+        with self.assertRaises(ValueError):
+            rail.Track().compose(abs).segment(workers=0)
+
+    def test_map_threaded_yields_failure_subclass_as_value(self):
+        class NotFailure(rail.Failure):
+            pass
+
+        value = NotFailure(ValueError())
+        results = rail.Track().compose(lambda _: value).map_threaded(
+            [1], lambda value, exception: self.fail()
+        )
+        self.assertEqual([value], list(results))
+
+    def test_map_threaded_invalid_queue_size(self):
+        results = rail.Track().compose(abs).map_threaded(
+            [1], lambda value, exception: self.fail(), queue_size=0
+        )
+        with self.assertRaises(ValueError):
+            list(results)
+
+    def test_map_threaded_stops_threads_when_closed(self):
+        thread_count = threading.active_count()
+        results = rail.Track().compose(abs).segment(workers=2).map_threaded(
+            itertools.count(), lambda value, exception: self.fail()
+        )
+        self.assertEqual(0, next(results))
+        results.close()
+        self.assertEqual(thread_count, threading.active_count())
+
+    def test_map_partitioned_preserves_per_key_order(self):
+        def process(event):
+            time.sleep(0.001 * (event[1] % 3))
+            return event
+        events = [(key, index) for index in range(20) for key in 'abcd']
+        results = list(rail.Track().compose(process).map_partitioned(
+            events, lambda value, exception: self.fail(),
+            key=operator.itemgetter(0), workers=3, queue_size=2
+        ))
+        self.assertCountEqual(events, results)
+        for key in 'abcd':
+            self.assertEqual(
+                [event for event in events if event[0] == key],
+                [event for event in results if event[0] == key]
+            )
+
+    def test_map_partitioned_same_key_same_worker(self):
+        threads = {}
+
+        def process(value):
+            threads.setdefault(value % 5, set()).add(threading.get_ident())
+            return value
+        list(rail.Track().compose(process).map_partitioned(
+            range(100), lambda value, exception: self.fail(),
+            key=lambda value: value % 5, workers=4
+        ))
+        self.assertEqual([1] * 5, [len(ident) for ident in threads.values()])
+
+    def test_map_partitioned_failures_handled_per_item(self):
+        failures = []
+        results = rail.Track().compose(int).map_partitioned(
+            ['1', 'x', '3', None, '5'],
+            lambda value, exception: failures.append(value),
+            key=len, workers=2, ordered=True
+        )
+        self.assertEqual([1, 3, 5], list(results))
+        self.assertEqual(['x', None], failures)
+
+    def test_map_partitioned_slow_partition_does_not_stall_others(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def process(value):
+            if value == 0:
+                release.wait(5)
+            return value
+        results = rail.Track().compose(process).map_partitioned(
+            range(6), lambda value, exception: self.fail(),
+            key=lambda value: value % 2, workers=2
+        )
+        self.assertEqual([1, 3, 5], list(itertools.islice(results, 3)))
+        release.set()
+        self.assertEqual([0, 2, 4], list(results))
+
+    def test_map_partitioned_invalid_sizes(self):
+        for kwargs in ({'workers': 0}, {'queue_size': 0}):
+            results = rail.Track().map_partitioned(
+                [1], lambda value, exception: self.fail(),
+                key=rail.identity, **kwargs
+            )
+            with self.assertRaises(ValueError):
+                list(results)
+
+    def test_map_partitioned_stops_threads_when_closed(self):
+        thread_count = threading.active_count()
+        results = rail.Track().compose(abs).map_partitioned(
+            itertools.count(), lambda value, exception: self.fail(),
+            key=rail.identity
+        )
+        self.assertEqual(0, next(results))
+        results.close()
+        self.assertEqual(thread_count, threading.active_count())
+
+    def test_map_batches_calls_vectorized_stage_with_batch(self):
+        func = unittest.mock.Mock(
+            side_effect=lambda values: [value * 2 for value in values]
+        )
+        results = rail.Track().compose(rail.vectorized(func)).map_batches(
+            [[1, 2, 3], [4]], lambda value, exception: self.fail()
+        )
+        self.assertEqual([[2, 4, 6], [8]], list(results))
+        self.assertEqual(
+            [unittest.mock.call([1, 2, 3]), unittest.mock.call([4])],
+            func.call_args_list
+        )
+
+    def test_map_batches_isolates_failing_elements(self):
+        batch_sizes = []
+
+        def invert(values):
+            batch_sizes.append(len(values))
+            return [1 / value for value in values]
+        handled = []
+        results = rail.Track().compose(
+            rail.vectorized(invert)
+        ).handle(
+            lambda exception: handled.append(exception) or 0
+        ).compose(
+            rail.vectorized(lambda values: [value * 4 for value in values])
+        ).map_batches(
+            [[1, 2, 0, 4]], lambda value, exception: self.fail()
+        )
+        self.assertEqual([[4.0, 2.0, 0, 1.0]], list(results))
+        self.assertEqual(1, len(handled))
+        self.assertIsInstance(handled[0], ZeroDivisionError)
+        self.assertEqual([4, 2, 2, 1, 1], batch_sizes)
+
+    def test_map_batches_runs_scalar_stages_per_element(self):
+        batch_sizes = []
+
+        def double(values):
+            batch_sizes.append(len(values))
+            return [value * 2 for value in values]
+        failures = []
+        results = rail.Track().compose(
+            int,
+            rail.vectorized(double)
+        ).map_batches(
+            [['1', 'x', '3', '4']],
+            lambda value, exception: failures.append(value)
+        )
+        self.assertEqual([[2, 6, 8]], list(results))
+        self.assertEqual(['x'], failures)
+        self.assertEqual([2, 1], sorted(batch_sizes, reverse=True))
+
+    def test_map_batches_concatenate(self):
+        results = rail.Track().compose(
+            rail.vectorized(lambda values: values),
+            lambda value: value if value else rail.Failure(ValueError())
+        ).map_batches(
+            [(1, 0, 2)],
+            lambda value, exception: None,
+            concatenate=lambda pieces: sum(map(tuple, pieces), ())
+        )
+        self.assertEqual([(1, 2)], list(results))
+
+    def test_vectorized_called_directly(self):
+        func = rail.Track().compose(rail.vectorized(abs))
+        self.assertEqual(3, func(-3))
+
+    def test_compile_matches_uncompiled_track(self):
+        func = rail.Track().compose(
+            lambda value: value if value > 0 else rail.raise_(
+                ValueError('value')
+            )
+        ).tee(
+            lambda value: value * 2
+        ).tee(
+            lambda value: rail.Failure(KeyError('key')) if value > 5
+            else value,
+            lambda value: value * 3
+        ).handle(
+            lambda exception: type(exception).__name__
+        ).fold(
+            lambda value: str(value),
+            lambda exception: rail.raise_()
+        )
+        compiled_func = func.compile()
+        for value in (-1, 1, 10):
+            self.assertEqual(func(value), compiled_func(value))
+
+    def test_compile_handle_traceback_with_exception(self):
+        exception = KeyError('key')
+        func = rail.Track().compose(
+            lambda _: rail.raise_(exception)
+        )
+        try:
+            func(unittest.mock.Mock())
+        except KeyError:
+            expected_exc_info = sys.exc_info()
+        try:
+            func.handle(rail.raise_).compile()(unittest.mock.Mock())
+        except KeyError:
+            actual_exc_info = sys.exc_info()
+        self.assertEqual(expected_exc_info[1], actual_exc_info[1])
+        expected_tb = traceback.format_tb(expected_exc_info[2])
+        actual_tb = traceback.format_tb(actual_exc_info[2])
+        self.assertEqual(expected_tb, actual_tb[-len(expected_tb):])
+
+    def test_compile_with_many_handlers(self):
+        func = rail.Track().compose(
+            lambda _: rail.raise_(ValueError('value'))
+        )
+        for _ in range(5000):
+            func = func.handle(rail.raise_)
+        func = func.handle(lambda exception: str(exception))
+        self.assertEqual('value', func.compile()(unittest.mock.Mock()))
+
+    def test_compile_returns_unhandled_failure(self):
+        exception = ValueError('value')
+        func = rail.Track().compose(
+            lambda _: rail.Failure(exception)
+        ).handle(
+            lambda exception: rail.Failure(exception)
+        ).compile()
+        self.assertEqual(exception, func(unittest.mock.Mock()).exception)
+
+    def test_compile_pickle_round_trip(self):
+        func = rail.Track().compose(int).tee(str).handle(type).compile()
+        unpickled_func = pickle.loads(pickle.dumps(func))
+        self.assertEqual(7, unpickled_func('7'))
+        self.assertEqual(ValueError, unpickled_func('x'))
+
+
+class TestCache(unittest.TestCase):
+    def test_result_cached(self):
+        func = unittest.mock.Mock(side_effect=lambda value: value * 2)
+        cache = rail.Cache(func)
+        self.assertEqual(
+            [2, 4, 2, 4], [cache(1), cache(2), cache(1), cache(2)]
+        )
+        self.assertEqual(2, func.call_count)
+        self.assertEqual(2, cache.stats()['hits'])
+        self.assertEqual(2, cache.stats()['misses'])
+
+    def test_least_recently_used_evicted(self):
+        func = unittest.mock.Mock(side_effect=rail.identity)
+        cache = rail.Cache(func, maxsize=2)
+        for value in (1, 2, 1, 3, 1, 2):
+            cache(value)
+        self.assertEqual(
+            [unittest.mock.call(value) for value in (1, 2, 3, 2)],
+            func.call_args_list
+        )
+        self.assertEqual(2, cache.stats()['evictions'])
+        self.assertEqual(2, cache.stats()['size'])
+
+    def test_entry_expires_after_ttl(self):
+        func = unittest.mock.Mock(side_effect=rail.identity)
+        cache = rail.Cache(func, ttl=10)
+        with unittest.mock.patch('time.monotonic', return_value=100):
+            cache(1)
+        with unittest.mock.patch('time.monotonic', return_value=109):
+            cache(1)
+        self.assertEqual(1, func.call_count)
+        with unittest.mock.patch('time.monotonic', return_value=110):
+            cache(1)
+        self.assertEqual(2, func.call_count)
+        self.assertEqual(1, cache.stats()['expirations'])
+
+    def test_key_func(self):
+        func = unittest.mock.Mock(side_effect=lambda value: value['id'])
+        cache = rail.Cache(func, key=lambda value: value['id'])
+        self.assertEqual(1, cache({'id': 1, 'name': 'a'}))
+        self.assertEqual(1, cache({'id': 1, 'name': 'b'}))
+        self.assertEqual(1, func.call_count)
+
+    def test_unhashable_value_not_cached(self):
+        func = unittest.mock.Mock(side_effect=len)
+        cache = rail.Cache(func)
+        self.assertEqual([2, 2], [cache([1, 2]), cache([1, 2])])
+        self.assertEqual(2, func.call_count)
+        self.assertEqual(2, cache.stats()['uncacheable'])
+
+    def test_failures_not_cached_by_default(self):
+        func = unittest.mock.Mock(side_effect=KeyError('key'))
+        cache = rail.Cache(func)
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                cache(1)
+        self.assertEqual(2, func.call_count)
+
+    def test_failures_cached(self):
+        exception = KeyError('key')
+        func = unittest.mock.Mock(side_effect=exception)
+        track = rail.Track().compose(func).cache(
+            cache_failures=True
+        ).handle(
+            rail.identity
+        )
+        self.assertIs(exception, track(1))
+        self.assertIs(exception, track(1))
+        self.assertEqual(1, func.call_count)
+
+    def test_cached_failure_returned_without_traceback(self):
+        cache = rail.Cache(
+            lambda _: rail.raise_(KeyError('key')), cache_failures=True
+        )
+        failure = cache(1)
+        self.assertIs(rail.Failure, failure.__class__)
+        self.assertIsInstance(failure.exception, KeyError)
+        self.assertIsNone(failure.exception.__traceback__)
+        self.assertIs(failure, cache(1))
+
+    def test_track_cache_wraps_existing_stages(self):
+        func1 = unittest.mock.Mock(side_effect=lambda value: value + 1)
+        func2 = unittest.mock.Mock(side_effect=lambda value: value * 2)
+        track = rail.Track().compose(func1).cache().compose(func2)
+        self.assertEqual([4, 4], [track(1), track(1)])
+        self.assertEqual(1, func1.call_count)
+        self.assertEqual(2, func2.call_count)
+
+    def test_pickle_round_trip(self):
+        cache = rail.Cache(abs, maxsize=4)
+        cache(-1)
+        unpickled_cache = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(1, unpickled_cache(-1))
+        self.assertEqual(4, unpickled_cache.stats()['maxsize'])
+        self.assertEqual(1, unpickled_cache.stats()['misses'])
+
+
+def run_concurrently(func, args, release=None):
+    results = [None] * len(args)
+
+    def run(index):
+        try:
+            results[index] = func(args[index])
+        except Exception as exception:
+            results[index] = exception
+    threads = [
+        threading.Thread(target=run, args=(index,))
+        for index in range(len(args))
+    ]
+    for thread in threads:
+        thread.start()
+    if release is not None:
+        deadline = time.monotonic() + 5
+        while func.func.stats()['calls'] < len(args):
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.001)
+        release.set()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+class TestCoalesce(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def test_concurrent_equal_keys_share_execution(self):
+        calls = []
+
+        def fetch(value):
+            calls.append(value)
+            self.release.wait(5)
+            return value * 2
+        func = rail.Track().compose(fetch).coalesce()
+        self.assertEqual(
+            [4] * 5, run_concurrently(func, [2] * 5, self.release)
+        )
+        self.assertEqual([2], calls)
+        self.assertEqual(
+            {'calls': 5, 'executions': 1, 'coalesced': 4, 'in_flight': 0},
+            func.func.stats()
+        )
+
+    def test_distinct_keys_not_coalesced(self):
+        def fetch(value):
+            self.release.wait(5)
+            return value * 2
+        func = rail.Track().compose(fetch).coalesce()
+        self.assertEqual(
+            [2, 4, 6], run_concurrently(func, [1, 2, 3], self.release)
+        )
+        self.assertEqual(3, func.func.stats()['executions'])
+
+    def test_key_function(self):
+        def fetch(value):
+            self.release.wait(5)
+            return value['id']
+        func = rail.Track().compose(fetch).coalesce(
+            key=operator.itemgetter('id')
+        )
+        self.assertEqual(
+            [1, 1],
+            run_concurrently(func, [{'id': 1}, {'id': 1}], self.release)
+        )
+        self.assertEqual(1, func.func.stats()['executions'])
+
+    def test_exception_shared(self):
+        exception = KeyError('key')
+
+        def fetch(value):
+            self.release.wait(5)
+            raise exception
+        func = rail.Track().compose(fetch).coalesce()
+        self.assertEqual(
+            [exception] * 3, run_concurrently(func, [1] * 3, self.release)
+        )
+        self.assertEqual(1, func.func.stats()['executions'])
+
+    def test_sequential_calls_execute_again(self):
+        func = rail.Track().compose(lambda value: value * 2).coalesce()
+        self.assertEqual(4, func(2))
+        self.assertEqual(4, func(2))
+        self.assertEqual(2, func.func.stats()['executions'])
+
+    def test_unhashable_key_not_coalesced(self):
+        func = rail.Track().compose(len).coalesce()
+        self.assertEqual(2, func([1, 2]))
+        self.assertEqual(0, func.func.stats()['calls'])
+
+    def test_async_concurrent_equal_keys_share_execution(self):
+        calls = []
+
+        async def fetch(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value * 2
+
+        async def run():
+            return await asyncio.gather(*[func(2) for _ in range(5)])
+        func = rail.AsyncTrack().compose(fetch).coalesce()
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual([4] * 5, loop.run_until_complete(run()))
+        finally:
+            loop.close()
+        self.assertEqual([2], calls)
+        self.assertEqual(
+            {'calls': 5, 'executions': 1, 'coalesced': 4, 'in_flight': 0},
+            func.func.stats()
+        )
+
+    def test_async_cancelled_caller_does_not_cancel_execution(self):
+        async def fetch(value):
+            await asyncio.sleep(0.01)
+            return value * 2
+
+        async def run():
+            first = asyncio.ensure_future(func(2))
+            second = asyncio.ensure_future(func(2))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+        func = rail.AsyncTrack().compose(fetch).coalesce()
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(4, loop.run_until_complete(run()))
+        finally:
+            loop.close()
+
+    def test_async_calls_not_shared_between_loops(self):
+        started = threading.Event()
+
+        async def fetch(value):
+            started.set()
+            await asyncio.sleep(0.05)
+            return value * 2
+
+        def run():
+            loop = asyncio.new_event_loop()
+            try:
+                results.append(loop.run_until_complete(func(2)))
+            finally:
+                loop.close()
+        func = rail.AsyncTrack().compose(fetch).coalesce()
+        results = []
+        thread = threading.Thread(target=run)
+        thread.start()
+        started.wait(5)
+        run()
+        thread.join()
+        self.assertEqual([4, 4], results)
+        self.assertEqual(2, func.func.stats()['executions'])
+
+    def test_pickle(self):
+        func = rail.Track().compose(abs).coalesce()
+        self.assertEqual(2, pickle.loads(pickle.dumps(func))(-2))
+
+
+class TestBatch(unittest.TestCase):
+    def test_concurrent_calls_grouped_into_bulk_call(self):
+        calls = []
+
+        def fetch(values):
+            calls.append(sorted(values))
+            return [value * 2 for value in values]
+        func = rail.Track().batch(fetch, max_size=4, max_wait=5)
+        self.assertEqual(
+            [2, 4, 6, 8], run_concurrently(func, [1, 2, 3, 4])
+        )
+        self.assertEqual([[1, 2, 3, 4]], calls)
+
+    def test_batch_flushed_after_max_wait(self):
+        batch = rail.Batch(
+            lambda values: [value * 2 for value in values], max_wait=0.01
+        )
+        self.assertEqual(4, rail.Track().compose(batch)(2))
+        self.assertEqual({1: 1}, batch.stats()['batch_sizes'])
+
+    def test_element_failure_returned_to_its_caller(self):
+        def fetch(values):
+            return [
+                rail.Failure(KeyError(value)) if value < 0 else value
+                for value in values
+            ]
+        func = rail.Track().batch(fetch, max_size=2, max_wait=5).handle(
+            lambda exception: type(exception)
+        )
+        self.assertEqual([KeyError, 1], run_concurrently(func, [-1, 1]))
+
+    def test_bulk_exception_raised_for_every_caller(self):
+        exception = KeyError('key')
+        func = rail.Track().batch(
+            lambda values: rail.raise_(exception), max_size=2, max_wait=5
+        )
+        self.assertEqual(
+            [exception, exception], run_concurrently(func, [1, 2])
+        )
+
+    def test_result_count_mismatch(self):
+        func = rail.Track().batch(lambda values: [], max_wait=0)
+        with self.assertRaises(ValueError):
+            func(1)
+
+    def test_invalid_max_size(self):
+        with self.assertRaises(ValueError):
+            rail.Batch(rail.identity, max_size=0)
+
+    def test_stats(self):
+        batch = rail.Batch(rail.identity, max_size=2, max_wait=5)
+        run_concurrently(batch, [1, 2])
+        stats = batch.stats()
+        self.assertEqual(2, stats['calls'])
+        self.assertEqual(1, stats['batches'])
+        self.assertEqual(2.0, stats['mean_batch_size'])
+        self.assertLess(stats['mean_wait_seconds'], 5)
+
+    def test_async_concurrent_calls_grouped_into_bulk_call(self):
+        calls = []
+
+        async def fetch(values):
+            calls.append(list(values))
+            await asyncio.sleep(0)
+            return [value * 2 for value in values]
+
+        async def run():
+            return await asyncio.gather(*[func(value) for value in range(5)])
+        func = rail.AsyncTrack().batch(fetch, max_size=3, max_wait=0.01)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(
+                [0, 2, 4, 6, 8], loop.run_until_complete(run())
+            )
+        finally:
+            loop.close()
+        self.assertEqual([[0, 1, 2], [3, 4]], calls)
+
+    def test_async_bulk_exception_raised_for_every_caller(self):
+        async def run():
+            return await asyncio.gather(
+                func(1), func(2), return_exceptions=True
+            )
+        func = rail.AsyncTrack().batch(
+            lambda values: rail.raise_(KeyError('key')), max_wait=0.01
+        )
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertEqual([KeyError, KeyError], list(map(type, results)))
+
+    def test_async_batches_not_shared_between_loops(self):
+        started = threading.Event()
+
+        async def run_first():
+            task = asyncio.ensure_future(func(1))
+            await asyncio.sleep(0)
+            started.set()
+            return await task
+
+        def run(coroutine):
+            loop = asyncio.new_event_loop()
+            try:
+                results.append(loop.run_until_complete(coroutine))
+            finally:
+                loop.close()
+        func = rail.AsyncTrack().batch(
+            lambda values: [value * 2 for value in values], max_wait=0.05
+        )
+        results = []
+        thread = threading.Thread(target=run, args=(run_first(),))
+        thread.start()
+        started.wait(5)
+        run(func(2))
+        thread.join()
+        self.assertEqual([2, 4], sorted(results))
+        self.assertEqual({1: 2}, func.func.stats()['batch_sizes'])
+
+    def test_pickle(self):
+        func = rail.Track().batch(list, max_wait=0)
+        self.assertEqual(2, pickle.loads(pickle.dumps(func))(2))
+
+
+class TestPool(unittest.TestCase):
+    def test_resource_reused_between_calls(self):
+        create = unittest.mock.Mock(side_effect=lambda: object())
+        pool = rail.Pool(create)
+        func = rail.Track().pooled(pool, lambda resource, value: resource)
+        self.assertIs(func(1), func(2))
+        create.assert_called_once_with()
+
+    def test_resource_returned_on_exception(self):
+        pool = rail.Pool(object, size=1)
+        func = rail.Track().pooled(
+            pool, lambda resource, value: rail.raise_(KeyError(value))
+        ).handle(
+            lambda exception: pool.stats()['in_use']
+        )
+        self.assertEqual(0, func(1))
+        self.assertEqual(1, pool.stats()['idle'])
+
+    def test_resource_returned_on_failure_value(self):
+        pool = rail.Pool(object, size=1)
+        func = rail.Track().pooled(
+            pool, lambda resource, value: rail.Failure(KeyError(value))
+        ).handle(
+            lambda exception: pool.stats()['in_use']
+        )
+        self.assertEqual(0, func(1))
+
+    def test_acquire_timeout(self):
+        pool = rail.Pool(object, size=1, timeout=0.01)
+        resource = pool.acquire()
+        with self.assertRaises(TimeoutError):
+            pool.acquire()
+        pool.release(resource)
+        self.assertIs(resource, pool.acquire())
+        self.assertEqual(1, pool.stats()['timeouts'])
+
+    def test_unhealthy_resource_replaced(self):
+        close = unittest.mock.Mock()
+        pool = rail.Pool(
+            object, check=lambda resource: resource is not broken,
+            close=close
+        )
+        broken = pool.acquire()
+        pool.release(broken)
+        resource = pool.acquire()
+        self.assertIsNot(broken, resource)
+        close.assert_called_once_with(broken)
+        self.assertEqual(
+            {
+                'size': 8, 'created': 2, 'discarded': 1, 'idle': 0,
+                'in_use': 1, 'timeouts': 0
+            },
+            pool.stats()
+        )
+
+    def test_create_exception_frees_slot(self):
+        pool = rail.Pool(
+            lambda: rail.raise_(KeyError('key')), size=1, timeout=0.01
+        )
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                pool.acquire()
+        self.assertEqual(0, pool.stats()['in_use'])
+
+    def test_check_exception_frees_slot(self):
+        pool = rail.Pool(
+            object, size=1, timeout=0.01,
+            check=lambda resource: rail.raise_(KeyError('key'))
+        )
+        pool.release(pool.acquire())
+        with self.assertRaises(KeyError):
+            pool.acquire()
+        self.assertEqual(
+            {'in_use': 0, 'idle': 0},
+            {name: pool.stats()[name] for name in ('in_use', 'idle')}
+        )
+
+    def test_size_limits_concurrent_use(self):
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def query(resource, value):
+            with lock:
+                active.append(value)
+                peak.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.remove(value)
+            return value
+        func = rail.Track().pooled(rail.Pool(object, size=2), query)
+        threads = [
+            threading.Thread(target=func, args=(value,))
+            for value in range(6)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertLessEqual(max(peak), 2)
+
+    def test_clear_closes_idle_resources(self):
+        close = unittest.mock.Mock()
+        pool = rail.Pool(object, close=close)
+        resource = pool.acquire()
+        pool.release(resource)
+        pool.clear()
+        close.assert_called_once_with(resource)
+        self.assertEqual(0, pool.stats()['idle'])
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            rail.Pool(object, size=0)
+
+    def test_async(self):
+        async def create():
+            return object()
+
+        async def query(resource, value):
+            await asyncio.sleep(0)
+            return resource
+
+        async def run():
+            return await asyncio.gather(*[func(value) for value in range(4)])
+        pool = rail.Pool(create, size=2)
+        func = rail.AsyncTrack().pooled(pool, query)
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertEqual(2, len(set(map(id, results))))
+        self.assertEqual(2, pool.stats()['idle'])
+
+    def test_async_resources_not_shared_between_event_loops(self):
+        async def borrow():
+            resource = await pool.acquire_async()
+            await asyncio.sleep(0)
+            await pool.release_async(resource)
+            return resource
+
+        async def run():
+            return await asyncio.gather(borrow(), borrow())
+        pool = rail.Pool(object, size=1)
+        resources = []
+        for _ in range(2):
+            loop = asyncio.new_event_loop()
+            try:
+                resources.extend(loop.run_until_complete(run()))
+            finally:
+                loop.close()
+        self.assertIs(resources[0], resources[1])
+        self.assertIs(resources[2], resources[3])
+        self.assertIsNot(resources[0], resources[2])
+        self.assertEqual(0, pool.stats()['in_use'])
+
+    def test_size_shared_between_threads_and_event_loops(self):
+        async def run():
+            with self.assertRaises(TimeoutError):
+                await pool.acquire_async()
+            threading.Timer(0.01, pool.release, (resource,)).start()
+            pool.timeout = 5
+            return await pool.acquire_async()
+        pool = rail.Pool(object, size=1, timeout=0.01)
+        resource = pool.acquire()
+        loop = asyncio.new_event_loop()
+        try:
+            async_resource = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertIsNot(resource, async_resource)
+        self.assertEqual(
+            {'in_use': 1, 'idle': 1},
+            {name: pool.stats()[name] for name in ('in_use', 'idle')}
+        )
+
+    def test_async_acquire_timeout(self):
+        async def run():
+            resource = await pool.acquire_async()
+            try:
+                await pool.acquire_async()
+            finally:
+                await pool.release_async(resource)
+        pool = rail.Pool(object, size=1, timeout=0.01)
+        loop = asyncio.new_event_loop()
+        try:
+            with self.assertRaises(TimeoutError):
+                loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_pickle(self):
+        pool = pickle.loads(pickle.dumps(rail.Pool(object, size=2)))
+        self.assertEqual(2, pool.stats()['size'])
+
+
+class TestFanOut(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def test_results_combined_in_order(self):
+        func = rail.fan_out(
+            lambda value: value + 1, lambda value: value * 2, str
+        )
+        self.assertEqual((4, 6, '3'), func(3))
+
+    def test_combine(self):
+        func = rail.Track().fan_out(
+            lambda value: {'a': value}, lambda value: {'b': value},
+            combine=lambda results: dict(itertools.chain.from_iterable(
+                result.items() for result in results
+            ))
+        )
+        self.assertEqual({'a': 1, 'b': 1}, func(1))
+
+    def test_branches_run_concurrently(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def branch(value):
+            barrier.wait()
+            return value
+        func = rail.fan_out(branch, branch, branch)
+        self.assertEqual((1, 1, 1), func(1))
+
+    def test_branches_limited_by_workers(self):
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def branch(value):
+            with lock:
+                active.append(value)
+                peak.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.remove(value)
+            return value
+        func = rail.fan_out(branch, branch, branch, workers=2)
+        self.assertEqual((1, 1, 1), func(1))
+        self.assertEqual(2, max(peak))
+
+    def test_pickle(self):
+        func = rail.fan_out(abs, str, workers=2)
+        unpickled_func = pickle.loads(pickle.dumps(func))
+        self.assertEqual((2, '-2'), unpickled_func(-2))
+        self.assertEqual(2, unpickled_func.workers.size)
+
+    def test_fail_fast_raises_without_waiting(self):
+        func = rail.Track().fan_out(
+            lambda value: self.release.wait(5),
+            lambda value: rail.raise_(KeyError(value))
+        ).handle(
+            lambda exception: type(exception)
+        )
+        self.assertEqual(KeyError, func(1))
+        self.assertFalse(self.release.is_set())
+
+    def test_fail_fast_returns_failure_value(self):
+        failure = rail.Failure(KeyError('key'))
+        func = rail.fan_out(rail.identity, lambda value: failure)
+        self.assertIs(failure, func(1))
+
+    def test_collect_all_passes_failures_to_combine(self):
+        exception = KeyError('key')
+        combine = unittest.mock.Mock()
+        func = rail.fan_out(
+            lambda value: rail.raise_(exception), rail.identity,
+            combine=combine, fail_fast=False
+        )
+        self.assertEqual(combine.return_value, func(1))
+        first, second = combine.call_args[0][0]
+        self.assertIs(exception, first.exception)
+        self.assertEqual(1, second)
+
+    def test_no_funcs(self):
+        with self.assertRaises(ValueError):
+            rail.fan_out()
+
+    def test_async_fail_fast_cancels_other_branches(self):
+        cancelled = []
+
+        async def slow(value):
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(value)
+                raise
+
+        async def fail(value):
+            raise KeyError(value)
+
+        async def run():
+            result = await func(1)
+            await asyncio.sleep(0)
+            return result
+        func = rail.AsyncTrack().fan_out(slow, fail).handle(
+            lambda exception: type(exception)
+        )
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(KeyError, loop.run_until_complete(run()))
+        finally:
+            loop.close()
+        self.assertEqual([1], cancelled)
+
+    def test_async_collect_all(self):
+        async def double(value):
+            await asyncio.sleep(0)
+            return value * 2
+
+        func = rail.AsyncTrack().fan_out(
+            double, lambda value: rail.raise_(KeyError(value)),
+            rail.AsyncTrack().compose(double, double),
+            combine=lambda results: [
+                type(result.exception) if isinstance(result, rail.Failure)
+                else result for result in results
+            ],
+            fail_fast=False
+        )
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(
+                [2, KeyError, 4], loop.run_until_complete(func(1))
+            )
+        finally:
+            loop.close()
+
+
+class TestTimeout(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def test_result_returned_within_timeout(self):
+        func = rail.Track().compose(lambda value: value * 2).timeout(1)
+        self.assertEqual(4, func(2))
+
+    def test_exception_raised_within_timeout(self):
+        func = rail.Track().compose(
+            lambda _: rail.raise_(KeyError('key'))
+        ).timeout(1)
+        with self.assertRaises(KeyError):
+            func(unittest.mock.Mock())
+
+    def test_expiry_routed_to_handle(self):
+        func = rail.Track().compose(
+            lambda value: self.release.wait(5)
+        ).timeout(0.01).handle(
+            lambda exception: type(exception)
+        )
+        self.assertEqual(TimeoutError, func(unittest.mock.Mock()))
+
+    def test_abandoned_calls_capped_by_workers(self):
+        func1 = unittest.mock.Mock(side_effect=lambda _: self.release.wait(5))
+        func = rail.Track().compose(func1).timeout(0.01, workers=1)
+        for _ in range(2):
+            with self.assertRaises(TimeoutError):
+                func(unittest.mock.Mock())
+        self.assertEqual(1, func1.call_count)
+
+    def test_pickle_round_trip(self):
+        func = rail.Track().compose(abs).timeout(1, workers=2)
+        unpickled_func = pickle.loads(pickle.dumps(func))
+        self.assertEqual(2, unpickled_func(-2))
+        self.assertEqual(2, unpickled_func.func.workers.size)
+
+    def test_async_expiry_routed_to_handle(self):
+        async def wait(_):
+            await asyncio.sleep(5)
+        func = rail.AsyncTrack().compose(wait).timeout(0.01).handle(
+            lambda exception: type(exception)
+        )
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(
+                TimeoutError,
+                loop.run_until_complete(func(unittest.mock.Mock()))
+            )
+        finally:
+            loop.close()
+
+
+class TestHedge(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def test_no_hedge_when_fast(self):
+        func = rail.Track().compose(lambda value: value * 2).hedge(delay=1)
+        self.assertEqual(4, func(2))
+        self.assertEqual(
+            {'calls': 1, 'hedged': 0, 'hedge_wins': 0, 'delay_seconds': 1},
+            func.func.stats()
+        )
+
+    def test_hedged_attempt_wins(self):
+        calls = []
+
+        def fetch(value):
+            calls.append(value)
+            if len(calls) == 1:
+                self.release.wait(5)
+            return value * 2
+        func = rail.Track().compose(fetch).hedge(delay=0.01)
+        self.assertEqual(4, func(2))
+        self.assertEqual([2, 2], calls)
+        self.assertEqual(1, func.func.stats()['hedge_wins'])
+
+    def test_no_hedge_when_workers_busy(self):
+        func1 = unittest.mock.Mock(
+            side_effect=lambda value: time.sleep(0.05) or value * 2
+        )
+        func = rail.Track().compose(func1).hedge(delay=0.01, workers=1)
+        self.assertEqual(4, func(2))
+        self.assertEqual(1, func1.call_count)
+        self.assertEqual(0, func.func.stats()['hedged'])
+
+    def test_failure_raised_when_all_attempts_fail(self):
+        func = rail.Track().compose(
+            lambda _: rail.raise_(KeyError('key'))
+        ).hedge(delay=1)
+        with self.assertRaises(KeyError):
+            func(unittest.mock.Mock())
+
+    def test_delay_from_latency_percentile(self):
+        hedge = rail.Hedge(rail.identity, percentile=0.9)
+        for value in range(rail.Hedge.MIN_SAMPLES - 1):
+            hedge(value)
+        self.assertIsNone(hedge.stats()['delay_seconds'])
+        hedge(unittest.mock.Mock())
+        self.assertLess(hedge.stats()['delay_seconds'], 1)
+
+    def test_no_hedge_when_percentile_exceeds_buckets(self):
+        hedge = rail.Hedge(lambda value: value * 2)
+        for _ in range(rail.Hedge.MIN_SAMPLES):
+            hedge.latency.record(12)
+        self.assertIsNone(hedge.stats()['delay_seconds'])
+        self.assertEqual(4, hedge(2))
+        self.assertEqual(0, hedge.stats()['hedged'])
+
+    def test_async_hedged_attempt_wins_and_loser_cancelled(self):
+        attempts = []
+        cancelled = []
+
+        async def fetch(value):
+            attempts.append(value)
+            try:
+                await asyncio.sleep(5 if len(attempts) == 1 else 0)
+            except asyncio.CancelledError:
+                cancelled.append(value)
+                raise
+            return value * 2
+
+        async def run():
+            result = await func(2)
+            await asyncio.sleep(0)
+            return result
+        func = rail.AsyncTrack().compose(fetch).hedge(delay=0.01)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(4, loop.run_until_complete(run()))
+        finally:
+            loop.close()
+        self.assertEqual([2, 2], attempts)
+        self.assertEqual([2], cancelled)
+
+
+class TestFailureLog(unittest.TestCase):
+    def test_records_compact_failures(self):
+        def parse(value):
+            return int(value)
+        log = rail.FailureLog(key=len)
+        results = rail.Track().compose(parse).map_stream(['1', 'xy'], log)
+        self.assertEqual([1], list(results))
+        record, = log
+        self.assertEqual(
+            ('ValueError', "invalid literal for int() with base 10: 'xy'",
+             'parse', 2),
+            record[:4]
+        )
+        self.assertIn('in parse', record.traceback)
+
+    def test_tracebacks_captured_for_first_of_each_type(self):
+        log = rail.FailureLog(tracebacks_per_type=2)
+        for value in range(3):
+            try:
+                raise KeyError(value)
+            except KeyError as exception:
+                log(value, exception)
+        self.assertEqual(
+            [True, True, False],
+            [record.traceback is not None for record in log]
+        )
+
+    def test_tracebacks_sampled(self):
+        log = rail.FailureLog(tracebacks_per_type=0, sample_rate=1.0)
+        try:
+            raise KeyError('key')
+        except KeyError as exception:
+            log(unittest.mock.Mock(), exception)
+        self.assertIsNotNone(next(iter(log)).traceback)
+
+    def test_message_truncated(self):
+        log = rail.FailureLog()
+        log(unittest.mock.Mock(), ValueError('x' * 1000))
+        self.assertEqual(
+            rail.FailureLog.MAX_MESSAGE_LENGTH, len(next(iter(log)).message)
+        )
+
+    def test_records_spilled_past_memory_limit(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        log = rail.FailureLog(
+            memory_limit=0, spill_path=os.path.join(directory.name, 'log')
+        )
+        for value in range(3):
+            log(value, ValueError(value))
+        self.assertEqual(
+            ['0', '1', '2'], [record.message for record in log]
+        )
+        self.assertEqual(
+            {'counts': {'ValueError': 3}, 'records': 0, 'memory': 0,
+             'spilled': 3, 'dropped': 0},
+            log.stats()
+        )
+
+    def test_spilled_key_not_serializable_as_json(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        log = rail.FailureLog(
+            key=lambda value: value.encode(), memory_limit=0,
+            spill_path=os.path.join(directory.name, 'log')
+        )
+        log('value', ValueError())
+        self.assertEqual(["b'value'"], [record.key for record in log])
+
+    def test_spill_path_reused(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'log')
+        for run in range(2):
+            log = rail.FailureLog(memory_limit=0, spill_path=path)
+            log(run, ValueError('run{0}'.format(run)))
+        self.assertEqual(['run1'], [record.message for record in log])
+
+    def test_records_dropped_without_spill_path(self):
+        log = rail.FailureLog(memory_limit=0)
+        log(unittest.mock.Mock(), ValueError())
+        self.assertEqual([], list(log))
+        self.assertEqual(1, log.stats()['dropped'])
+
+    def test_input_values_not_kept_alive(self):
+        class Payload:
+            pass
+        payload = Payload()
+        reference = weakref.ref(payload)
+        log = rail.FailureLog()
+        list(rail.Track().compose(
+            lambda value: rail.raise_(ValueError('value'))
+        ).map_stream([payload], log))
+        del payload
+        gc.collect()
+        self.assertIsNone(reference())
+
+
+class TestMetrics(unittest.TestCase):
+    def test_named_stages_recorded(self):
+        metrics = rail.Metrics()
+        func = rail.Track(metrics=metrics).compose(
+            int, name='parse'
+        ).tee(
+            lambda _: None, name='log'
+        ).handle(
+            lambda exception: -1, name='default'
+        ).compose(
+            abs
+        )
+        self.assertEqual([1, 1, 3], [func(value) for value in '1x3'])
+        snapshot = metrics.snapshot()
+        self.assertEqual({'parse', 'log', 'default'}, set(snapshot))
+        self.assertEqual(3, snapshot['parse']['count'])
+        self.assertEqual({'ValueError': 1}, snapshot['parse']['exceptions'])
+        self.assertEqual(2, snapshot['log']['count'])
+        self.assertEqual(1, snapshot['default']['count'])
+        self.assertEqual({}, snapshot['default']['exceptions'])
+
+    def test_fold_records_success_and_exception_funcs(self):
+        metrics = rail.Metrics()
+        func = rail.Track(metrics=metrics).compose(
+            lambda value: value if value else rail.raise_(ValueError())
+        ).fold(str, lambda exception: 'failed', name='fold')
+        self.assertEqual(['1', 'failed'], [func(1), func(0)])
+        self.assertEqual(2, metrics.snapshot()['fold']['count'])
+
+    def test_latency_recorded(self):
+        metrics = rail.Metrics()
+        func = rail.Track(metrics=metrics).compose(
+            rail.identity, name='sleep'
+        )
+        with unittest.mock.patch.object(
+            rail.time, 'perf_counter', side_effect=[1.0, 1.002]
+        ):
+            func(unittest.mock.Mock())
+        stage = metrics.snapshot()['sleep']
+        self.assertAlmostEqual(0.002, stage['total_seconds'])
+        self.assertEqual(0.0025, stage['p50_seconds'])
+        self.assertEqual(1, stage['buckets'][0.0025])
+
+    def test_exception_reraised_with_traceback(self):
+        exception = KeyError('key')
+        func = rail.Track(metrics=rail.Metrics()).compose(
+            lambda _: rail.raise_(exception), name='raise'
+        ).handle(
+            rail.raise_, name='reraise'
+        )
+        with self.assertRaises(KeyError) as context:
+            func(unittest.mock.Mock())
+        self.assertIs(exception, context.exception)
+
+    def test_pickle_round_trip_with_fresh_metrics(self):
+        func = rail.Track(metrics=rail.Metrics()).compose(int, name='parse')
+        func('1')
+        unpickled_func = pickle.loads(pickle.dumps(func))
+        self.assertEqual(7, unpickled_func('7'))
+        self.assertEqual('parse', unpickled_func.func.metrics.name)
+        self.assertEqual(1, unpickled_func.func.metrics.count)
+        self.assertEqual(
+            1, unpickled_func.metrics.snapshot()['parse']['count']
+        )
+
+    def test_stages_not_wrapped_without_metrics(self):
+        func1 = unittest.mock.Mock()
+        func = rail.Track().compose(func1, name='stage')
+        self.assertIs(func1, func.func)
+
+    def test_to_prometheus(self):
+        metrics = rail.Metrics(prefix='app')
+        func = rail.Track(metrics=metrics).compose(
+            lambda _: rail.raise_(KeyError('key')), name='lookup'
+        ).handle(lambda exception: None)
+        func(unittest.mock.Mock())
+        lines = metrics.to_prometheus().splitlines()
+        self.assertIn('# TYPE app_stage_seconds histogram', lines)
+        self.assertIn(
+            'app_stage_seconds_bucket{stage="lookup",le="+Inf"} 1', lines
+        )
+        self.assertIn('app_stage_seconds_count{stage="lookup"} 1', lines)
+        self.assertIn(
+            'app_stage_exceptions_total{stage="lookup",exception="KeyError"}'
+            ' 1',
+            lines
+        )
+
+
+class TestAsyncTrack(unittest.TestCase):
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_compose_with_sync_and_async_funcs(self):
+        async def double(value):
+            return value * 2
+        func = rail.AsyncTrack().compose(
+            lambda value: value + 1,
+            double,
+            lambda value: value + 3
+        )
+        self.assertEqual(11, self.run_async(func(3)))
+
+    def test_tee_with_async_func(self):
+        values = []
+
+        async def append(value):
+            values.append(value)
+        func = rail.AsyncTrack().tee(append).compose(lambda value: value * 2)
+        self.assertEqual(8, self.run_async(func(4)))
+        self.assertEqual([4], values)
+
+    def test_handle_with_async_exception(self):
+        expected_exception = KeyError('key')
+
+        async def raise_(_):
+            raise expected_exception
+        func = rail.AsyncTrack().compose(raise_).handle(rail.identity)
+        self.assertEqual(
+            expected_exception, self.run_async(func(unittest.mock.Mock()))
+        )
+
+    def test_fold_with_async_funcs(self):
+        async def validate(value):
+            return value if value > 0 else rail.raise_(ValueError('value'))
+
+        async def describe(exception):
+            return str(exception)
+        func = rail.AsyncTrack().compose(validate).fold(
+            lambda value: str(value),
+            describe
+        )
+        self.assertEqual('5', self.run_async(func(5)))
+        self.assertEqual('value', self.run_async(func(-5)))
+
+    def test_handle_reraises_exception(self):
+        async def raise_(_):
+            raise KeyError('key')
+        func = rail.AsyncTrack().compose(raise_).handle(rail.raise_)
+        with self.assertRaises(KeyError):
+            self.run_async(func(unittest.mock.Mock()))
+
+    def test_handle_with_async_failure(self):
+        async def fail(_):
+            return rail.Failure(KeyError('key'))
+        func = rail.AsyncTrack().compose(fail, unittest.mock.Mock()).handle(
+            lambda exception: 'handled'
+        )
+        self.assertEqual('handled', self.run_async(func(unittest.mock.Mock())))
+
+    def test_compile_with_sync_and_async_funcs(self):
+        async def validate(value):
+            return value if value > 0 else rail.raise_(ValueError('value'))
+        func = rail.AsyncTrack().compose(validate).cache().fold(
+            lambda value: value * 2,
+            lambda exception: str(exception)
+        ).compile()
+        self.assertEqual(6, self.run_async(func(3)))
+        self.assertEqual('value', self.run_async(func(-3)))
+
+    def test_map_threaded_unsupported(self):
+        with self.assertRaises(TypeError):
+            rail.AsyncTrack().map_threaded([1], unittest.mock.Mock())
+
+    def test_map_batches_unsupported(self):
+        with self.assertRaises(TypeError):
+            rail.AsyncTrack().map_batches([[1]], unittest.mock.Mock())
+
+    def test_map_parallel_unsupported(self):
+        with self.assertRaises(TypeError):
+            rail.AsyncTrack().map_parallel([1], unittest.mock.Mock())
+
+    def test_map_partitioned_unsupported(self):
+        with self.assertRaises(TypeError):
+            rail.AsyncTrack().map_partitioned(
+                [1], unittest.mock.Mock(), key=rail.identity
+            )
+
+    def test_cache_with_async_func(self):
+        calls = []
+
+        async def fetch(value):
+            calls.append(value)
+            return value * 2
+        func = rail.AsyncTrack().compose(fetch).cache()
+        self.assertEqual(4, self.run_async(func(2)))
+        self.assertEqual(4, self.run_async(func(2)))
+        self.assertEqual([2], calls)
+
+    def test_map_stream_over_async_iterable(self):
+        async def values():
+            for value in range(5):
+                yield value
+
+        async def delay(value):
+            await asyncio.sleep(0.001 * (5 - value))
+            return value
+        failures = []
+        func = rail.AsyncTrack().compose(
+            delay,
+            lambda value: value if value != 2 else rail.raise_(KeyError(2))
+        )
+
+        async def collect():
+            return [
+                result async for result in func.map_stream(
+                    values(),
+                    lambda value, exception: failures.append(value),
+                    concurrency=3
+                )
+            ]
+        self.assertEqual([0, 1, 3, 4], self.run_async(collect()))
+        self.assertEqual([2], failures)
+
+    def test_map_stream_limits_concurrency(self):
+        running = []
+        peak = []
+
+        async def track_concurrency(value):
+            running.append(value)
+            peak.append(len(running))
+            await asyncio.sleep(0.001)
+            running.remove(value)
+            return value
+        func = rail.AsyncTrack().compose(track_concurrency)
+
+        async def collect():
+            return [
+                result async for result in func.map_stream(
+                    range(10), lambda value, exception: None, concurrency=4
+                )
+            ]
+        self.assertEqual(list(range(10)), self.run_async(collect()))
+        self.assertEqual(4, max(peak))
+
 
 if __name__ == '__main__':
     unittest.main()